@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from metrics import Counter
+
+breaker_transitions = Counter("zabbix_suite_api_breaker_transitions_total", "Circuit breaker state changes toward the Zabbix API", ["state"])
+
+
+# Class that limits concurrent and per-second requests to an API
+# The concurrency limit follows the latency (AIMD): +1 after a full window of fast requests, halved on slow or failed ones
+class AdaptiveLimiter:
+    def __init__(self, max_concurrency=16, min_concurrency=1, max_rate=0, latency_target=2.0):
+        self._max = max(max_concurrency, 1)
+        self._min = max(min(min_concurrency, self._max), 1)
+        self._rate = max_rate  # Calls per second, 0 for no limit
+        self._latency_target = latency_target  # Seconds, slower requests lower the limit
+        self.limit = float(self._max)
+        self._in_flight = 0
+        self._tokens = float(max_rate)
+        self._refilled = time.monotonic()
+        self._last_decrease = 0
+        self._changed = threading.Condition()
+
+    def in_flight(self):
+        with self._changed:
+            return self._in_flight
+
+    # Function to wait for a free request slot and a rate token, a request with several calls (batch) uses a token for each
+    # Returns False if there was no free slot within timeout seconds
+    def acquire(self, calls=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                if self._rate:
+                    self._tokens = min(self._rate, self._tokens + (now - self._refilled) * self._rate)
+                    self._refilled = now
+                slot_free = self._in_flight < int(self.limit)
+                if slot_free and (not self._rate or self._tokens >= 1):
+                    break
+                # A free slot is signalled by release(), missing tokens are waited for
+                wait = (1 - self._tokens) / self._rate if slot_free else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._changed.wait(wait)
+            self._in_flight += 1
+            if self._rate:
+                # A big batch can take the bucket below zero, the next requests wait until it is paid back
+                self._tokens -= calls
+            return True
+
+    # Function to free the slot of a finished request and adapt the limit, latency is None for requests that were not sent
+    def release(self, latency=None, failed=False):
+        with self._changed:
+            self._in_flight -= 1
+            if latency is not None:
+                self._adapt(latency, failed)
+            self._changed.notify_all()
+
+    def _adapt(self, latency, failed):
+        now = time.monotonic()
+        if failed or latency > self._latency_target:
+            # Requests sent together report the same overload, so the limit is lowered once per round trip
+            if now - self._last_decrease < latency or self.limit <= self._min:
+                return
+            self.limit = max(self._min, self.limit / 2)
+            self._last_decrease = now
+            logging.warning(f"Zabbix API concurrency limit lowered to {int(self.limit)}, "
+                            f"request {'failed after' if failed else 'took'} {latency:.2f}s")
+        elif self.limit < self._max:
+            self.limit = min(self._max, self.limit + 1 / self.limit)
+            if self.limit == self._max:
+                logging.info(f"Zabbix API concurrency limit back at {self._max}")
+
+
+# Class with a circuit breaker, requests are stopped after failure_threshold failed requests in a row
+# After cooldown seconds one request is let through to test the API (half open), it closes the breaker or opens it again
+class CircuitBreaker:
+    states = ("closed", "half_open", "open")  # The position is the value of the breaker state gauge
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self._failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0  # Failed requests in a row
+        self._opened = None  # Time the breaker opened or the last test request failed, None while it is closed
+        self._outage_started = None  # Time the breaker opened after being closed
+        self._probing = False  # The test request of the half open state is in flight
+        self._lock = threading.Lock()
+
+    # Function to return "closed", "half_open" (the cooldown is over) or "open"
+    def state(self):
+        with self._lock:
+            if self._opened is None:
+                return "closed"
+            if self._probing or time.monotonic() - self._opened >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    # Function to check if a request would be let through now, without taking the test request
+    def available(self):
+        with self._lock:
+            return self._opened is None or (not self._probing and time.monotonic() - self._opened >= self.cooldown)
+
+    # Function to return the seconds until the next test request, 0 while the breaker is closed
+    def retry_in(self):
+        with self._lock:
+            if self._opened is None:
+                return 0
+            return max(self.cooldown - (time.monotonic() - self._opened), 0)
+
+    # Function to ask if a request can be sent, in the half open state only one test request is let through
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or time.monotonic() - self._opened < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    # Function to record the result of a request that was let through by allow()
+    def record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+                if self._opened is not None:
+                    logging.info(f"Zabbix API responds again, circuit breaker closed after {time.monotonic() - self._outage_started:.0f}s")
+                    self._opened = None
+                    self._probing = False
+                    breaker_transitions.inc("closed")
+                return
+            self._failures += 1
+            if self._probing:
+                self._opened = time.monotonic()
+                self._probing = False
+                logging.warning(f"Zabbix API is still unavailable, next test request in {self.cooldown:.0f}s")
+                breaker_transitions.inc("open")
+            elif self._opened is None and self._failures >= self._failure_threshold:
+                self._opened = self._outage_started = time.monotonic()
+                logging.error(f"Zabbix API failed {self._failures} times in a row, circuit breaker open for {self.cooldown:.0f}s")
+                breaker_transitions.inc("open")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the classification rules over recorded NetBox webhooks
+# Run from the suite directory: python3 benchmarks/classification_benchmark.py webhooks.jsonl
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from classification import ClassificationRules
+
+
+# Function to read recorded webhooks or VMs from a JSON Lines file or a JSON array, returns the VM objects
+def load_corpus(path):
+    with open(path, "r") as corpus_file:
+        if path.endswith(".jsonl"):
+            items = [json.loads(line) for line in corpus_file if line.strip()]
+        else:
+            items = json.load(corpus_file)
+            if isinstance(items, dict):
+                items = items.get("results", [])
+    return [item.get("data", {}) if "event" in item else item for item in items]
+
+
+# Function to build VMs with random names, platforms, sites and tags when no recorded payloads are at hand
+def synthetic_corpus(size, seed=1):
+    generator = random.Random(seed)
+    platforms = ["Windows Server 2019", "Ubuntu 22.04", "CentOS 7", "Debian 12", "FreeBSD", None]
+    sites = ["pluto-vcenter", "jupiter-vcenter", "mars"]
+    tags = ["uniq", "cpanel", "orphaned", "backup", "web"]
+    names = ["web{}", "srv-cp{:02d}", "host {} cp 01", "cpanel-{}", "db{}", "ebay-{}"]
+    return [{
+        "id": index,
+        "name": generator.choice(names).format(index % 100),
+        "status": {"value": generator.choice(["active"] * 9 + ["offline"])},
+        "primary_ip": {"address": f"{generator.choice(['172.16', '10.20'])}.{index // 256 % 256}.{index % 256}/24"},
+        "platform": {"name": generator.choice(platforms)},
+        "site": {"name": generator.choice(sites)},
+        "cluster": {"name": generator.choice(["prod"] * 9 + ["test"])},
+        "tags": [{"name": tag} for tag in generator.sample(tags, generator.randint(0, 2))],
+        "custom_fields": {}
+    } for index in range(size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure classifications per second of the classification rules")
+    parser.add_argument("corpus", nargs="?", help="recorded webhooks (.jsonl) or VMs (.json), synthetic VMs if not given")
+    parser.add_argument("--rules", default="classification_rules.json", help="rules file (default: classification_rules.json)")
+    parser.add_argument("--synthetic", type=int, default=10000, help="number of synthetic VMs (default: 10000)")
+    parser.add_argument("--rounds", type=int, default=20, help="passes over the corpus (default: 20)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rules = ClassificationRules.from_file(args.rules)
+    compiled = time.perf_counter()
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic)
+
+    outcomes = Counter()
+    for vm in corpus:
+        netbox_host, reason = rules.classify(vm)
+        outcomes["classified" if netbox_host is not None else reason] += 1
+
+    classify = rules.classify
+    timings = []
+    for _ in range(args.rounds):
+        round_started = time.perf_counter()
+        for vm in corpus:
+            classify(vm)
+        timings.append(time.perf_counter() - round_started)
+    timings.sort()
+
+    report = {
+        "corpus": args.corpus or f"synthetic ({len(corpus)} VMs)",
+        "vms": len(corpus),
+        "rounds": args.rounds,
+        "compile_ms": round((compiled - started) * 1000, 3),
+        "classifications_per_second": round(len(corpus) / timings[len(timings) // 2]),
+        "best_classifications_per_second": round(len(corpus) / timings[0]),
+        "microseconds_per_classification": round(timings[len(timings) // 2] / len(corpus) * 1e6, 2),
+        "outcomes": dict(outcomes)
+    }
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
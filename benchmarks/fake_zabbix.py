@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Zabbix JSON-RPC API, for benchmarks and load tests
+# Run: python3 benchmarks/fake_zabbix.py --port 18080 --latency-ms 20 --error-rate 0.01
+# Then start the suite with ZABBIX_URL=http://127.0.0.1:18080/api_jsonrpc.php
+# An outage is simulated with: curl -d '{"seconds": 60}' http://127.0.0.1:18080/outage
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from classification import ClassificationRules
+
+
+# Exception answered with a JSON-RPC error object
+class APIError(Exception):
+    def __init__(self, message, data="", code=-32602):
+        super().__init__(message)
+        self.code = code
+        self.data = data
+
+
+# Class with the hosts, templates, groups and proxies of the fake Zabbix server
+class FakeZabbix:
+    def __init__(self, templates, groups, proxies, session_ttl=0):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(10001)
+        self.templates = {name: str(next(self._ids)) for name in templates}
+        self.groups = {name: str(next(self._ids)) for name in groups}
+        self.proxies = {name: str(next(self._ids)) for name in proxies}
+        self.hosts = {}  # hostid -> host object as sent to host.create
+        self.hostids_by_ip = {}
+        self.sessions = {}  # token -> expiry time (0 means never)
+        self.session_ttl = session_ttl
+        self.calls = Counter()
+        self.errors = Counter()
+        self.requests = 0
+        self.writes = {}  # ip -> time of the first host.create or host.update after the last reset
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.requests = 0
+            self.writes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "hosts": len(self.hosts),
+                "writes": dict(self.writes)
+            }
+
+    # Function to add hosts that exist before the benchmark, so webhooks also lead to updates and no-ops
+    def preload_hosts(self, count, network="10.200"):
+        template_ids = list(self.templates.values())[:1]
+        group_ids = list(self.groups.values())[:1]
+        for index in range(count):
+            self._create_host({
+                "host": f"preloaded-{index}",
+                "name": f"preloaded-{index}",
+                "interfaces": [{"ip": f"{network}.{index // 256 % 256}.{index % 256}"}],
+                "tls_connect": 2,
+                "templates": [{"templateid": templateid} for templateid in template_ids],
+                "groups": [{"groupid": groupid} for groupid in group_ids]
+            })
+
+    def _create_host(self, params):
+        ip_address = params["interfaces"][0]["ip"]
+        if ip_address in self.hostids_by_ip:
+            raise APIError("Invalid params.", f"Host with IP \"{ip_address}\" already exists.")
+        hostid = str(next(self._ids))
+        host = dict(params)
+        host["templates"] = [dict(template) for template in params.get("templates", [])]
+        host["groups"] = [dict(group) for group in params.get("groups", [])]
+        self.hosts[hostid] = host
+        self.hostids_by_ip[ip_address] = hostid
+        return hostid
+
+    def _host_object(self, hostid, params):
+        host = self.hosts[hostid]
+        template_names = {templateid: name for name, templateid in self.templates.items()}
+        group_names = {groupid: name for name, groupid in self.groups.items()}
+        result = {"hostid": hostid, "host": host["host"], "name": host.get("name", host["host"])}
+        if "selectParentTemplates" in params:
+            result["parentTemplates"] = [{"templateid": template["templateid"], "name": template_names.get(template["templateid"], "")}
+                                         for template in host["templates"]]
+        for select in ("selectGroups", "selectHostGroups"):
+            if select in params:
+                result["groups" if select == "selectGroups" else "hostgroups"] = [
+                    {"groupid": group["groupid"], "name": group_names.get(group["groupid"], "")} for group in host["groups"]]
+        if "selectInterfaces" in params:
+            result["interfaces"] = [{"ip": interface["ip"]} for interface in host["interfaces"]]
+        return result
+
+    def _check_auth(self, auth):
+        expiry = self.sessions.get(auth)
+        if expiry is None or (expiry and expiry < time.monotonic()):
+            self.sessions.pop(auth, None)
+            raise APIError("Invalid params.", "Session terminated, re-login, please.")
+
+    # Function to answer one JSON-RPC call, raises APIError
+    def call(self, method, params, auth):
+        with self._lock:
+            self.calls[method] += 1
+            if method == "user.login":
+                token = "%032x" % random.getrandbits(128)
+                self.sessions[token] = time.monotonic() + self.session_ttl if self.session_ttl else 0
+                return token
+            if method == "apiinfo.version":
+                return "6.0.0"
+            self._check_auth(auth)
+            if method == "user.logout":
+                self.sessions.pop(auth, None)
+                return True
+            if method == "template.get":
+                names = params.get("filter", {}).get("host") or params.get("filter", {}).get("name") or list(self.templates)
+                return [{"templateid": self.templates[name], "host": name, "name": name} for name in names if name in self.templates]
+            if method == "hostgroup.get":
+                names = params.get("filter", {}).get("name") or list(self.groups)
+                groups = [{"groupid": self.groups[name], "name": name} for name in names if name in self.groups]
+                return groups[:params["limit"]] if "limit" in params else groups
+            if method == "hostgroup.create":
+                groupids = []
+                for group in params if isinstance(params, list) else [params]:
+                    self.groups.setdefault(group["name"], str(next(self._ids)))
+                    groupids.append(self.groups[group["name"]])
+                return {"groupids": groupids}
+            if method == "proxy.get":
+                proxies = [{"proxyid": proxyid, "host": name} for name, proxyid in self.proxies.items()]
+                if "selectHosts" in params:
+                    for proxy in proxies:
+                        proxy["hosts"] = [{"hostid": hostid} for hostid, host in self.hosts.items() if host.get("proxy_hostid") == proxy["proxyid"]]
+                return proxies
+            if method == "host.get":
+                if "filter" in params and "ip" in params["filter"]:
+                    ips = params["filter"]["ip"]
+                    hostids = [self.hostids_by_ip[ip] for ip in (ips if isinstance(ips, list) else [ips]) if ip in self.hostids_by_ip]
+                elif "hostids" in params:
+                    hostids = [hostid for hostid in params["hostids"] if hostid in self.hosts]
+                else:
+                    hostids = list(self.hosts)
+                # Other filter fields are compared with the fields the host was created or updated with
+                for field, values in params.get("filter", {}).items():
+                    if field != "ip":
+                        values = {str(value) for value in (values if isinstance(values, list) else [values])}
+                        hostids = [hostid for hostid in hostids if str(self.hosts[hostid].get(field)) in values]
+                return [self._host_object(hostid, params) for hostid in hostids]
+            if method == "host.create":
+                hosts = params if isinstance(params, list) else [params]
+                # Like Zabbix, a host.create array is created completely or not at all
+                ips = [host["interfaces"][0]["ip"] for host in hosts]
+                for ip_address in ips:
+                    if ip_address in self.hostids_by_ip or ips.count(ip_address) > 1:
+                        raise APIError("Invalid params.", f"Host with IP \"{ip_address}\" already exists.")
+                hostids = [self._create_host(host) for host in hosts]
+                for ip_address in ips:
+                    self.writes.setdefault(ip_address, time.time())
+                return {"hostids": hostids}
+            if method == "host.update":
+                host = self.hosts.get(params.get("hostid"))
+                if host is None:
+                    raise APIError("Invalid params.", "No permissions to referred object or it does not exist!")
+                for field, value in params.items():
+                    if field in ("templates", "groups"):
+                        host[field] = [{"templateid" if field == "templates" else "groupid": item} if isinstance(item, str) else dict(item) for item in value]
+                    elif field == "templates_clear":
+                        cleared = {template["templateid"] for template in value}
+                        host["templates"] = [template for template in host["templates"] if template["templateid"] not in cleared]
+                    elif field != "hostid":
+                        host[field] = value
+                self.writes.setdefault(host["interfaces"][0]["ip"], time.time())
+                return {"hostids": [params["hostid"]]}
+            if method in ("host.massadd", "host.massupdate", "host.massremove"):
+                hostids = params["hostids"] if method == "host.massremove" else [host["hostid"] for host in params["hosts"]]
+                hosts = [self.hosts.get(hostid) for hostid in hostids]
+                if None in hosts:
+                    raise APIError("Invalid params.", "No permissions to referred object or it does not exist!")
+                for host in hosts:
+                    for field, id_field in (("templates", "templateid"), ("groups", "groupid")):
+                        if method == "host.massremove":
+                            removed = set(params.get(f"{id_field}s", []))
+                            host[field] = [item for item in host[field] if item[id_field] not in removed]
+                        elif field in params:
+                            current = [] if method == "host.massupdate" else [item for item in host[field]]
+                            known = {item[id_field] for item in current}
+                            host[field] = current + [dict(item) for item in params[field] if item[id_field] not in known]
+                    if not host["groups"]:
+                        raise APIError("Invalid params.", f"Host \"{host['host']}\" cannot be without host group.")
+                    self.writes.setdefault(host["interfaces"][0]["ip"], time.time())
+                return {"hostids": hostids}
+            raise APIError("Incorrect API \"%s\"." % method, code=-32601)
+
+
+def make_handler(zabbix, latency, jitter, error_rate, http_error_rate):
+    outage = {"until": 0}  # Requests are answered with status 503 until this time
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, zabbix.stats())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/reset":
+                zabbix.reset_stats()
+                self._reply(200, {"reset": True})
+                return
+            if self.path == "/outage":
+                outage["until"] = time.time() + float(json.loads(body or b"{}").get("seconds", 60))
+                self._reply(200, {"outage_until": outage["until"]})
+                return
+            with zabbix._lock:
+                zabbix.requests += 1
+            time.sleep(max(latency + random.uniform(-jitter, jitter), 0))
+            if time.time() < outage["until"]:
+                with zabbix._lock:
+                    zabbix.errors["outage"] += 1
+                self._reply(503, {"error": "Simulated outage"})
+                return
+            if random.random() < http_error_rate:
+                with zabbix._lock:
+                    zabbix.errors["http"] += 1
+                self._reply(500, {"error": "Injected HTTP error"})
+                return
+            try:
+                request = json.loads(body)
+            except ValueError:
+                self._reply(200, {"jsonrpc": "2.0", "error": {"code": -32700, "message": "Parse error.", "data": ""}, "id": None})
+                return
+
+            def answer(call):
+                try:
+                    if random.random() < error_rate:
+                        with zabbix._lock:
+                            zabbix.errors["injected"] += 1
+                        raise APIError("Application error.", "Injected error.", code=-32500)
+                    result = zabbix.call(call["method"], call.get("params", {}), call.get("auth"))
+                    return {"jsonrpc": "2.0", "result": result, "id": call.get("id")}
+                except APIError as e:
+                    return {"jsonrpc": "2.0", "error": {"code": e.code, "message": str(e), "data": e.data}, "id": call.get("id")}
+                except (KeyError, TypeError, IndexError) as e:
+                    return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.", "data": repr(e)}, "id": call.get("id")}
+
+            self._reply(200, [answer(call) for call in request] if isinstance(request, list) else answer(request))
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Zabbix JSON-RPC API for benchmarks")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--rules", default="classification_rules.json", help="templates, groups and proxies are taken from these rules")
+    parser.add_argument("--latency-ms", type=float, default=20, help="delay of every HTTP request (default: 20)")
+    parser.add_argument("--jitter-ms", type=float, default=5, help="random +- change of the delay (default: 5)")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of calls answered with an API error (default: 0)")
+    parser.add_argument("--http-error-rate", type=float, default=0, help="share of HTTP requests answered with status 500 (default: 0)")
+    parser.add_argument("--session-ttl", type=float, default=0, help="seconds before a session expires, 0 for never (default: 0)")
+    parser.add_argument("--hosts", type=int, default=0, help="hosts created before the benchmark in 10.200.0.0/16 (default: 0)")
+    args = parser.parse_args()
+
+    rules = ClassificationRules.from_file(args.rules)
+    zabbix = FakeZabbix(rules.template_names(), rules.group_names(), rules.proxy_names(), session_ttl=args.session_ttl)
+    zabbix.preload_hosts(args.hosts)
+    handler = make_handler(zabbix, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.http_error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    server.daemon_threads = True
+    print(f"Fake Zabbix API on http://127.0.0.1:{args.port}/api_jsonrpc.php, stats on /stats", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
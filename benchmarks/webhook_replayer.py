@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Load test: sends NetBox VM webhooks to the suite at a set rate and concurrency and writes a JSON report
+# Run: python3 benchmarks/webhook_replayer.py --count 2000 --rate 200 --concurrency 16 --output run.json
+
+import argparse
+import http.client
+import itertools
+import json
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from classification_benchmark import load_corpus, synthetic_corpus
+
+
+# Function to return the value at a percentile of sorted values, None for no values
+def percentile(values, share):
+    if not values:
+        return None
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2) if values else None,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+        "max_ms": round(values[-1] * 1000, 2) if values else None
+    }
+
+
+# Function to wrap a VM into a webhook like the ones NetBox sends
+def netbox_webhook(vm, sequence):
+    return {
+        "event": "updated",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "model": "virtualmachine",
+        "username": "benchmark",
+        "request_id": f"benchmark-{sequence}",
+        "data": vm,
+        "snapshots": {"prechange": None, "postchange": None}
+    }
+
+
+# Function to build VMs with the IP addresses of hosts preloaded by fake_zabbix.py --hosts, they lead to host.update
+def existing_vms(count, network="10.200"):
+    return [{
+        "id": 1000000 + index,
+        "name": f"preloaded-{index}",
+        "status": {"value": "active"},
+        "primary_ip": {"address": f"{network}.{index // 256 % 256}.{index % 256}/24"},
+        "platform": {"name": "Ubuntu 22.04"},
+        "site": {"name": "pluto-vcenter"},
+        "cluster": {"name": "prod"},
+        "tags": [],
+        "custom_fields": {}
+    } for index in range(count)]
+
+
+def get_json(url, data=None):
+    request = urllib.request.Request(url, data=data, method="POST" if data is not None else "GET")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+class Replayer:
+    def __init__(self, url, webhooks, rate, concurrency):
+        parts = urlsplit(url)
+        self._host = parts.hostname
+        self._port = parts.port or 80
+        self._path = parts.path or "/"
+        self._webhooks = webhooks
+        self._rate = rate
+        self._concurrency = concurrency
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.lag = []  # Seconds a send started after its planned time, shows if the rate was not reached
+        self.statuses = Counter()
+        self.first_sent = {}  # IP address -> time of the first webhook
+
+    def _worker(self, started):
+        connection = http.client.HTTPConnection(self._host, self._port, timeout=30)
+        while True:
+            index = next(self._next)
+            if index >= len(self._webhooks):
+                break
+            webhook = self._webhooks[index]
+            if self._rate:
+                planned = started + index / self._rate
+                delay = planned - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                lag = max(time.monotonic() - planned, 0)
+            else:
+                lag = 0
+            body = json.dumps(webhook).encode()
+            ip_address = ((webhook["data"].get("primary_ip") or {}).get("address") or "").split("/")[0]
+            sent = time.time()
+            request_started = time.perf_counter()
+            try:
+                connection.request("POST", self._path, body=body, headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                status = str(response.status)
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+                connection.close()
+            latency = time.perf_counter() - request_started
+            with self._lock:
+                self.statuses[status] += 1
+                self.latencies.append(latency)
+                self.lag.append(lag)
+                self.first_sent.setdefault(ip_address, sent)
+        connection.close()
+
+    def run(self):
+        started = time.monotonic()
+        threads = [threading.Thread(target=self._worker, args=(started,)) for _ in range(self._concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send NetBox VM webhooks to the suite and report latency and throughput")
+    parser.add_argument("--url", default="http://127.0.0.1:17777/", help="suite listener (default: http://127.0.0.1:17777/)")
+    parser.add_argument("--zabbix", default="http://127.0.0.1:18080", help="fake_zabbix.py for API call counts and end-to-end latency, empty to skip")
+    parser.add_argument("--corpus", help="recorded webhooks (.jsonl) or VMs (.json) instead of synthetic VMs")
+    parser.add_argument("--vms", type=int, default=1000, help="different synthetic VMs (default: 1000)")
+    parser.add_argument("--existing", type=int, default=0, help="VMs matching hosts preloaded with fake_zabbix.py --hosts (default: 0)")
+    parser.add_argument("--count", type=int, default=2000, help="webhooks to send, VMs are repeated in order (default: 2000)")
+    parser.add_argument("--rate", type=float, default=0, help="webhooks per second, 0 for as fast as possible (default: 0)")
+    parser.add_argument("--concurrency", type=int, default=8, help="connections sending at the same time (default: 8)")
+    parser.add_argument("--settle-timeout", type=float, default=120, help="seconds to wait for the work queue to empty (default: 120)")
+    parser.add_argument("--label", default="", help="free text stored in the report, for example the commit")
+    parser.add_argument("--output", default="-", help="JSON report file (default: standard output)")
+    args = parser.parse_args()
+
+    vms = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.vms)
+    vms = existing_vms(args.existing) + vms
+    webhooks = [netbox_webhook(vms[index % len(vms)], index) for index in range(args.count)]
+    listener = f"http://{urlsplit(args.url).netloc}"
+
+    if args.zabbix:
+        get_json(f"{args.zabbix}/reset", b"{}")
+    replayer = Replayer(args.url, webhooks, args.rate, args.concurrency)
+    duration = replayer.run()
+    print(f"{len(webhooks)} webhooks sent in {duration:.1f}s, waiting for the work queue", file=sys.stderr)
+
+    # Webhooks are acknowledged before processing, end-to-end numbers need the queue to be empty
+    settle_started = time.monotonic()
+    queue = None
+    while time.monotonic() - settle_started < args.settle_timeout:
+        try:
+            queue = get_json(f"{listener}/queue")
+        except OSError:
+            break
+        if queue["depth"] == 0:
+            break
+        time.sleep(0.2)
+    settled = time.monotonic() - settle_started
+
+    report = {
+        "label": args.label,
+        "time": datetime.now(timezone.utc).isoformat(),
+        "settings": {
+            "count": args.count, "rate": args.rate, "concurrency": args.concurrency,
+            "vms": len(vms), "existing": args.existing, "corpus": args.corpus or "synthetic"
+        },
+        "sent": len(webhooks),
+        "statuses": dict(replayer.statuses),
+        "send_seconds": round(duration, 3),
+        "webhooks_per_second": round(len(webhooks) / duration, 1) if duration else None,
+        "ack_latency": latency_summary(replayer.latencies),
+        "schedule_lag": latency_summary(replayer.lag),
+        "settle_seconds": round(settled, 3),
+        "queue_after": queue
+    }
+    if args.zabbix:
+        stats = get_json(f"{args.zabbix}/stats")
+        calls = sum(stats["calls"].values())
+        end_to_end = [write - replayer.first_sent[ip] for ip, write in stats["writes"].items() if ip in replayer.first_sent]
+        report.update({
+            "processed_webhooks_per_second": round(len(webhooks) / (duration + settled), 1),
+            "end_to_end_latency": latency_summary(end_to_end),
+            "api_requests": stats["requests"],
+            "api_calls": calls,
+            "api_calls_by_method": stats["calls"],
+            "api_calls_per_webhook": round(calls / len(webhooks), 3),
+            "api_errors": stats["errors"],
+            "hosts_written": len(stats["writes"])
+        })
+
+    output = json.dumps(report, indent=4)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+        print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
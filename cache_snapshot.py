@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import time
+
+
+# Function to write the lookup caches to a file, parts is a dictionary of objects with a snapshot() function
+# The file is replaced in one step, a crash while writing leaves the previous snapshot
+def save_snapshot(path, parts):
+    started = time.monotonic()
+    snapshot = {"saved": time.time()}
+    for name, part in parts.items():
+        snapshot[name] = part.snapshot()
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    try:
+        with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file, separators=(",", ":"))
+        os.replace(temporary_path, path)
+    except OSError as e:
+        logging.warning(f"Cache snapshot {path} was not saved: {e}")
+        return False
+    logging.info(f"Cache snapshot {path} saved in {time.monotonic() - started:.2f}s")
+    return True
+
+
+# Function to load the lookup caches from a file, parts is a dictionary of objects with a load_snapshot() function
+# Returns False if there is no usable snapshot, the caches are then loaded from Zabbix
+def load_snapshot(path, parts, max_age):
+    started = time.monotonic()
+    try:
+        with open(path, "r") as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        logging.warning(f"Cache snapshot {path} can not be read: {e}")
+        return False
+    age = time.time() - snapshot.get("saved", 0)
+    if age > max_age:
+        logging.info(f"Cache snapshot {path} is not used, it is {age:.0f}s old")
+        return False
+    try:
+        for name, part in parts.items():
+            part.load_snapshot(snapshot[name])
+    except (KeyError, TypeError, ValueError) as e:
+        logging.warning(f"Cache snapshot {path} is not valid: {e!r}")
+        return False
+    logging.info(f"Cache snapshot {path} ({age:.0f}s old) loaded in {time.monotonic() - started:.2f}s")
+    return True
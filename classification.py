@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import ipaddress
+import json
+import re
+
+# Fields of a NetBox VM the exclude rules can test
+rule_fields = {"name", "platform", "cluster", "site", "status", "tags"}
+
+
+# Exception for rules files that can not be compiled
+class RuleError(ValueError):
+    pass
+
+
+# Function to compile substrings and an optional regular expression into one pattern, None if both are empty
+def compile_pattern(substrings=(), regex=None):
+    if isinstance(substrings, str):
+        substrings = [substrings]
+    parts = [re.escape(substring.lower()) for substring in substrings]
+    if regex:
+        parts.append(f"(?:{regex})")
+    try:
+        return re.compile("|".join(parts)) if parts else None
+    except re.error as e:
+        raise RuleError(f"Invalid regular expression {regex!r}: {e}")
+
+
+# Function to compile a list of CIDR networks
+def compile_networks(networks):
+    try:
+        return [ipaddress.ip_network(network) for network in networks]
+    except ValueError as e:
+        raise RuleError(f"Invalid network: {e}")
+
+
+# Function to read the proxies of a group, names or {"name": ..., "capacity": ...}, as proxy name -> capacity
+# A proxy with capacity 2 gets twice as many hosts as a proxy with capacity 1
+def proxy_capacities(members):
+    capacities = {}
+    for member in members:
+        if isinstance(member, str):
+            capacities[member] = 1.0
+            continue
+        try:
+            capacity = float(member.get("capacity", 1))
+        except (TypeError, ValueError):
+            capacity = 0
+        if capacity <= 0:
+            raise RuleError(f"Invalid capacity of proxy {member.get('name')!r}")
+        capacities[member["name"]] = capacity
+    return capacities
+
+
+# Function to read the lower case fields the rules work with from a NetBox VM
+def vm_facts(vm):
+    return {
+        "name": (vm.get("name") or "").lower(),
+        "platform": ((vm.get("platform") or {}).get("name") or "").lower(),
+        "cluster": ((vm.get("cluster") or {}).get("name") or "").lower(),
+        "site": ((vm.get("site") or {}).get("name") or "").lower(),
+        "status": ((vm.get("status") or {}).get("value") or "").lower(),
+        # List, not set, so tag templates and groups are added in the order of the tags
+        "tags": [tag["name"].lower() for tag in vm.get("tags") or [] if tag.get("name")]
+    }
+
+
+# Class with classification rules compiled once from a rules file
+# classify() assigns templates, groups and proxy to a NetBox VM, or returns the reason it is not monitored
+class ClassificationRules:
+    def __init__(self, config, source="<config>"):
+        self.source = source
+        try:
+            self._excludes = [self._compile_exclude(rule) for rule in config.get("exclude", [])]
+            self._platforms = [(
+                compile_pattern(platform.get("contains", ()), platform.get("regex")),
+                list(platform.get("templates", [])),
+                list(platform.get("groups", [])),
+                [(
+                    compile_pattern(name_rule.get("contains", ()), name_rule.get("regex")),
+                    list(name_rule.get("templates", [])),
+                    list(name_rule.get("groups", []))
+                ) for name_rule in platform.get("name_rules", [])]
+            ) for platform in config["platforms"]]
+            self._no_platform_reason = config.get("no_platform_reason", "no matches with the platform type")
+            self._tags = {tag.lower(): (list(rule.get("templates", [])), list(rule.get("groups", [])))
+                          for tag, rule in config.get("tags", {}).items()}
+            proxy = config.get("proxy", {})
+            if "ip_prefixes" in proxy or "sites" in proxy:
+                raise RuleError(f"Invalid classification rules in {source}: proxy ip_prefixes and sites were replaced by networks and groups")
+            self._proxy_networks = compile_networks(proxy.get("networks", []))
+            self._proxy_groups = [(
+                group["name"],
+                compile_networks(group.get("networks", [])),
+                [site.lower() for site in group.get("sites", [])],
+                proxy_capacities(group["proxies"])
+            ) for group in proxy.get("groups", [])]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise RuleError(f"Invalid classification rules in {source}: {e!r}")
+        if any(pattern is None for pattern, _, _, _ in self._platforms):
+            raise RuleError(f"Invalid classification rules in {source}: platform rule without contains or regex")
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with open(path, "r") as rules_file:
+                config = json.load(rules_file)
+        except (OSError, ValueError) as e:
+            raise RuleError(f"Classification rules {path} can not be read: {e}")
+        return cls(config, path)
+
+    @staticmethod
+    def _compile_exclude(rule):
+        field = rule["field"]
+        if field not in rule_fields:
+            raise RuleError(f"Unknown field {field!r} in exclude rule")
+        reason = rule["reason"]
+        if "any_of" in rule:
+            values = frozenset(value.lower() for value in rule["any_of"])
+            if field == "tags":
+                return lambda facts: reason if not values.isdisjoint(facts["tags"]) else None
+            return lambda facts: reason if facts[field] in values else None
+        if "not_in" in rule:
+            values = frozenset(value.lower() for value in rule["not_in"])
+            return lambda facts: reason if facts[field] not in values else None
+        pattern = compile_pattern(rule.get("contains", ()), rule.get("regex"))
+        if pattern is None:
+            raise RuleError(f"Exclude rule for {field!r} needs any_of, not_in, contains or regex")
+        if field == "tags":
+            return lambda facts: reason if any(pattern.search(tag) for tag in facts["tags"]) else None
+        return lambda facts: reason if pattern.search(facts[field]) else None
+
+    # Function to return all template names the rules can assign
+    def template_names(self):
+        names = [name for _, templates, _, name_rules in self._platforms
+                 for name in templates + [name for _, rule_templates, _ in name_rules for name in rule_templates]]
+        names += [name for templates, _ in self._tags.values() for name in templates]
+        return list(dict.fromkeys(names))
+
+    # Function to return all group names the rules can assign
+    def group_names(self):
+        names = [name for _, _, groups, name_rules in self._platforms
+                 for name in groups + [name for _, _, rule_groups in name_rules for name in rule_groups]]
+        names += [name for _, groups in self._tags.values() for name in groups]
+        return list(dict.fromkeys(names))
+
+    # Function to return all proxy names of the proxy groups
+    def proxy_names(self):
+        return list(dict.fromkeys(name for _, _, _, proxies in self._proxy_groups for name in proxies))
+
+    # Function to return the proxy groups as group name -> {proxy name: capacity}
+    def proxy_groups(self):
+        return {name: dict(proxies) for name, _, _, proxies in self._proxy_groups}
+
+    # Function to return (netbox_host, None) or (None, reason) when the VM must not be monitored
+    def classify(self, vm):
+        # IP address set with netmask discard if there is one
+        ip_address = (vm.get("primary_ip") or {}).get("address")
+        if not ip_address:
+            return None, "no primary IP address"
+        ip_address = ip_address.split('/')[0]
+
+        facts = vm_facts(vm)
+        for exclude in self._excludes:
+            reason = exclude(facts)
+            if reason is not None:
+                return None, reason
+
+        for pattern, platform_templates, platform_groups, name_rules in self._platforms:
+            if pattern.search(facts["platform"]):
+                templates = list(platform_templates)
+                groups = list(platform_groups)
+                for name_pattern, rule_templates, rule_groups in name_rules:
+                    if name_pattern.search(facts["name"]):
+                        templates.extend(rule_templates)
+                        groups.extend(rule_groups)
+                break
+        else:
+            return None, self._no_platform_reason
+
+        for tag in facts["tags"]:
+            tag_rule = self._tags.get(tag)
+            if tag_rule is not None:
+                templates.extend(tag_rule[0])
+                groups.extend(tag_rule[1])
+
+        # A group is chosen by the network of the IP address, or by the site for the networks monitored through proxies
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None, "invalid primary IP address"
+        proxied = any(address in network for network in self._proxy_networks)
+        proxy_group = ""
+        for name, networks, sites, _ in self._proxy_groups:
+            if any(address in network for network in networks) or (proxied and any(site in facts["site"] for site in sites)):
+                proxy_group = name
+                break
+        else:
+            if proxied:
+                return None, f"no proxy for site \"{facts['site']}\""
+
+        host_name = (vm.get("custom_fields") or {}).get("vcsa_vm_guest_hostname")
+        if host_name is None:
+            # Set visible name as a hostname
+            host_name = vm.get("name") or ""
+
+        return {
+            "hostname": host_name,
+            "visiblename": vm.get("name") or "",
+            "ip": ip_address,
+            # Rules can assign the same template or group more than once, every name is kept once
+            "templates": list(dict.fromkeys(templates)),
+            "groups": list(dict.fromkeys(groups)),
+            "proxy_group": proxy_group
+        }, None
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+schema = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    vm_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    applied REAL NOT NULL
+);
+"""
+
+
+# Function to return a fingerprint of the fields of a classified VM that are written to Zabbix
+# Templates and groups are compared as sets in check_zabbix_accuracy(), so their order does not change the fingerprint
+def fingerprint(netbox_host):
+    fields = [
+        netbox_host["hostname"],
+        netbox_host["visiblename"],
+        netbox_host["ip"],
+        sorted(netbox_host["templates"]),
+        sorted(netbox_host["groups"]),
+        netbox_host["proxy_group"]
+    ]
+    return hashlib.blake2b(json.dumps(fields).encode(), digest_size=16).hexdigest()
+
+
+# Class with the fingerprint of the last state written to Zabbix for every VM ID, least recently used first
+# With a path the fingerprints are also kept in SQLite and loaded again after a restart
+class FingerprintCache:
+    def __init__(self, max_entries=100000, ttl=86400, path=None):
+        self._max_entries = max_entries
+        self._ttl = ttl  # Seconds a fingerprint is trusted, changes made in Zabbix by hand are corrected after that
+        self._entries = OrderedDict()  # vm_id -> (fingerprint, applied)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._open(path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _open(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        os.chmod(path, 0o600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(schema)
+        # Expired fingerprints and the ones that do not fit are not loaded
+        self._db.execute("DELETE FROM fingerprints WHERE applied < ?", (time.time() - self._ttl,))
+        rows = self._db.execute("SELECT vm_id, fingerprint, applied FROM fingerprints ORDER BY applied DESC LIMIT ?",
+                                (self._max_entries,)).fetchall()
+        for vm_id, value, applied in reversed(rows):
+            self._entries[vm_id] = (value, applied)
+        if len(rows) == self._max_entries:
+            self._db.execute("DELETE FROM fingerprints WHERE applied < ?", (rows[-1][2],))
+        logging.info(f"Fingerprint cache {path} loaded with {len(rows)} VMs")
+
+    # Function to check if this fingerprint is the last one written to Zabbix for the VM
+    def matches(self, vm_id, value):
+        with self._lock:
+            entry = self._entries.get(vm_id)
+            if entry is None:
+                return False
+            if time.time() - entry[1] > self._ttl:
+                del self._entries[vm_id]
+                return False
+            self._entries.move_to_end(vm_id)
+            return entry[0] == value
+
+    # Function to remember the fingerprint after the VM was written to Zabbix or found up to date
+    def put(self, vm_id, value):
+        applied = time.time()
+        with self._lock:
+            self._entries[vm_id] = (value, applied)
+            self._entries.move_to_end(vm_id)
+            evicted = []
+            while len(self._entries) > self._max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            if self._db is None:
+                return
+            # The cache works from memory if the file can not be written, it is only slower after a restart
+            try:
+                self._db.execute("INSERT OR REPLACE INTO fingerprints (vm_id, fingerprint, applied) VALUES (?, ?, ?)",
+                                 (vm_id, value, applied))
+                self._db.executemany("DELETE FROM fingerprints WHERE vm_id = ?", [(evicted_id,) for evicted_id in evicted])
+            except sqlite3.Error as e:
+                logging.warning(f"Fingerprint of VM {vm_id} was not saved: {e}")
+
+    # Function to forget a VM, its next webhook is compared with Zabbix again
+    def invalidate(self, vm_id):
+        with self._lock:
+            if self._entries.pop(vm_id, None) is None or self._db is None:
+                return
+            try:
+                self._db.execute("DELETE FROM fingerprints WHERE vm_id = ?", (vm_id,))
+            except sqlite3.Error as e:
+                logging.warning(f"Fingerprint of VM {vm_id} was not removed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
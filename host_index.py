@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from zabbix_api import ZabbixAPIError
+
+# Host fields kept in the index, the same ones check_ip_in_zabbix() asks for
+host_fields = {
+    "output": ["hostid", "host", "name"],
+    "selectParentTemplates": ["templateid", "name"],
+    "selectGroups": ["groupid", "name"],
+    "selectInterfaces": ["ip"]
+}
+
+
+# Function to copy a host entry, so callers can change it without touching the index
+def copy_host(zabbix_host):
+    host = dict(zabbix_host)
+    host["groups"] = [dict(group) for group in zabbix_host["groups"]]
+    host["templates"] = [dict(template) for template in zabbix_host["templates"]]
+    return host
+
+
+# Class with monitored Zabbix hosts indexed by interface IP address
+# Entries have the same format as the zabbix_host dictionary from check_ip_in_zabbix()
+class HostIndex:
+    def __init__(self, client, max_hosts=100000, page_size=500):
+        self._client = client
+        self._max_hosts = max_hosts
+        self._page_size = page_size
+        self._hosts = OrderedDict()  # ip -> host entry, least recently used first
+        self._hostids = set()  # IDs of all hosts seen in Zabbix during the last refresh
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self.complete = False  # True while every host of the last warm-up fits in the index
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hosts)
+
+    def __contains__(self, ip_address):
+        with self._lock:
+            return ip_address in self._hosts
+
+    # Function to return a copy of the host with this IP, or None if it is not in the index
+    def lookup(self, ip_address):
+        with self._lock:
+            zabbix_host = self._hosts.get(ip_address)
+            if zabbix_host is None:
+                return None
+            self._hosts.move_to_end(ip_address)
+            return copy_host(zabbix_host)
+
+    # Function to add or replace a host after it was read from or written to Zabbix
+    def put(self, zabbix_host):
+        with self._lock:
+            self._store(zabbix_host)
+
+    # Function to drop one IP address, the next lookup will ask Zabbix again
+    def invalidate(self, ip_address):
+        with self._lock:
+            self._hosts.pop(ip_address, None)
+
+    # Function to drop all entries
+    def invalidate_all(self):
+        with self._lock:
+            self._hosts.clear()
+            self._hostids.clear()
+
+    def _store(self, zabbix_host):
+        self._hosts[zabbix_host["ip"]] = copy_host(zabbix_host)
+        self._hosts.move_to_end(zabbix_host["ip"])
+        self._hostids.add(zabbix_host["hostid"])
+        # Memory is bounded, the least recently used hosts are dropped and looked up in Zabbix when needed
+        while len(self._hosts) > self._max_hosts:
+            self._hosts.popitem(last=False)
+            self.complete = False
+
+    @staticmethod
+    def _host_entries(host):
+        for interface in host.get("interfaces", []):
+            if interface.get("ip"):
+                yield {
+                    "hostid": host["hostid"],
+                    "hostname": host["host"],
+                    "visiblename": host["name"],
+                    "ip": interface["ip"],
+                    "groups": host["groups"],
+                    "templates": host["parentTemplates"]
+                }
+
+    # Function to read full host details in pages of hostids
+    def _fetch_hosts(self, hostids):
+        hostids = sorted(hostids, key=int)
+        for start in range(0, len(hostids), self._page_size):
+            params = dict(host_fields, hostids=hostids[start:start + self._page_size])
+            for host in self._client.call("host.get", params):
+                yield from self._host_entries(host)
+
+    # Function to load the index with all hosts from Zabbix
+    def warm(self):
+        started = time.monotonic()
+        try:
+            hostids = {host["hostid"] for host in self._client.call("host.get", {"output": ["hostid"]})}
+            entries = list(self._fetch_hosts(hostids))
+        except ZabbixAPIError as e:
+            logging.warning(f"Host index warm-up failed with error: {e}")
+            return False
+        with self._lock:
+            self._hosts.clear()
+            for zabbix_host in entries:
+                self._store(zabbix_host)
+            self._hostids = hostids
+            self.complete = len(entries) <= self._max_hosts
+            indexed = len(self._hosts)
+        logging.info(f"Host index loaded with {indexed} IP addresses of {len(hostids)} hosts in {time.monotonic() - started:.1f}s")
+        return True
+
+    # Function to return the index for the cache snapshot
+    def snapshot(self):
+        with self._lock:
+            return {"hostids": list(self._hostids), "hosts": list(self._hosts.values())}
+
+    # Function to load the index from the cache snapshot, it is checked against Zabbix by the next warm()
+    def load_snapshot(self, snapshot):
+        with self._lock:
+            self._hosts.clear()
+            for zabbix_host in snapshot["hosts"]:
+                self._store(zabbix_host)
+            self._hostids = set(snapshot["hostids"])
+            # Only a warm-up from Zabbix makes the index complete, zabbix_reconcile.py depends on it
+            self.complete = False
+        logging.info(f"Host index loaded from the snapshot with {len(snapshot['hosts'])} IP addresses")
+
+    # Function to add hosts created since the last refresh and drop deleted ones
+    def refresh(self):
+        try:
+            hostids = {host["hostid"] for host in self._client.call("host.get", {"output": ["hostid"]})}
+            with self._lock:
+                new_hostids = hostids - self._hostids
+                removed_hostids = self._hostids - hostids
+            entries = list(self._fetch_hosts(new_hostids))
+        except ZabbixAPIError as e:
+            logging.warning(f"Host index refresh failed with error: {e}")
+            return False
+        with self._lock:
+            for ip_address in [ip for ip, host in self._hosts.items() if host["hostid"] in removed_hostids]:
+                del self._hosts[ip_address]
+            for zabbix_host in entries:
+                self._store(zabbix_host)
+            self._hostids = hostids
+        if new_hostids or removed_hostids:
+            logging.info(f"Host index refreshed: {len(new_hostids)} new and {len(removed_hostids)} deleted hosts")
+        return True
+
+    # Function to add hosts with known IDs, used right after host.create
+    def load_hosts(self, hostids):
+        try:
+            entries = list(self._fetch_hosts(hostids))
+        except ZabbixAPIError as e:
+            logging.warning(f"Host index update for hosts {hostids} failed with error: {e}")
+            return False
+        with self._lock:
+            for zabbix_host in entries:
+                self._store(zabbix_host)
+        return True
+
+    # Function to start a background thread with incremental refreshes and periodic full reloads
+    def start_refresh(self, interval, full_interval, stop_event):
+        def refresh_loop():
+            last_full = time.monotonic()
+            while not stop_event.wait(interval):
+                # Changes made to existing hosts outside this service are only seen by a full reload
+                if time.monotonic() - last_full >= full_interval:
+                    if self.warm():
+                        last_full = time.monotonic()
+                else:
+                    self.refresh()
+        self._refresh_thread = threading.Thread(target=refresh_loop, name="host-index-refresh", daemon=True)
+        self._refresh_thread.start()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+from http import HTTPStatus
+
+
+# Exception for requests that are answered with an error status and then closed
+class HTTPError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+# Exception for connections closed by the client between requests
+class ConnectionClosed(Exception):
+    pass
+
+
+# Class with one parsed HTTP request
+class HTTPRequest:
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers  # Header names in lower case
+        self.body = body  # bytearray, json.loads() parses it without decoding to str first
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+# Class with a client connection and the bytes received but not parsed yet
+class HTTPConnection:
+    def __init__(self, client_socket, client_addr):
+        self.socket = client_socket
+        self.addr = client_addr
+        self.buffer = bytearray()
+        self.last_active = time.monotonic()
+        self.requests = 0  # Requests answered on this connection
+
+    def _fill(self):
+        data = self.socket.recv(65536)
+        if not data:
+            raise ConnectionClosed()
+        self.buffer += data
+
+    # Function to return bytes up to the delimiter and remove them with the delimiter from the buffer
+    def read_until(self, delimiter, limit, status):
+        start = 0
+        while True:
+            end = self.buffer.find(delimiter, start)
+            if end != -1:
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end + len(delimiter)]
+                return data
+            if len(self.buffer) > limit:
+                raise HTTPError(status)
+            start = max(len(self.buffer) - len(delimiter) + 1, 0)
+            self._fill()
+
+    # Function to read exactly size bytes into target, the rest of the body goes straight from the socket
+    def read_into(self, target, offset, size):
+        buffered = min(len(self.buffer), size)
+        target[offset:offset + buffered] = self.buffer[:buffered]
+        del self.buffer[:buffered]
+        view = memoryview(target)
+        received = buffered
+        while received < size:
+            count = self.socket.recv_into(view[offset + received:offset + size])
+            if count == 0:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Connection closed before the end of the body")
+            received += count
+
+    def send(self, data):
+        self.socket.sendall(data)
+        self.last_active = time.monotonic()
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+# Function to read one request, raises ConnectionClosed if the client closed an idle connection
+def read_request(connection, max_header_size=16384, max_body_size=1048576):
+    try:
+        head = connection.read_until(b"\r\n\r\n", max_header_size, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+    except ConnectionClosed:
+        if connection.buffer:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Connection closed in the middle of headers")
+        raise
+    lines = head.decode("latin-1").split("\r\n")
+    # Empty lines before the request line are allowed by RFC 9112
+    while lines and not lines[0]:
+        lines.pop(0)
+    try:
+        method, path, version = lines[0].split(" ")
+    except (IndexError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid request line")
+    if not version.startswith("HTTP/1."):
+        raise HTTPError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if not separator or not name or name != name.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid header line")
+        name = name.lower()
+        headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+
+    if headers.get("expect", "").lower() == "100-continue":
+        connection.send(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+    transfer_encoding = headers.get("transfer-encoding", "").lower()
+    if transfer_encoding:
+        # Both headers at once is a request smuggling attempt
+        if "content-length" in headers or transfer_encoding != "chunked":
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Unsupported transfer encoding")
+        body = read_chunked_body(connection, max_header_size, max_body_size)
+    else:
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length > max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = bytearray(length)
+        connection.read_into(body, 0, length)
+    return HTTPRequest(method, path, version, headers, body)
+
+
+# Function to read a body sent with Transfer-Encoding: chunked
+def read_chunked_body(connection, max_line_size, max_body_size):
+    body = bytearray()
+    while True:
+        size_line = connection.read_until(b"\r\n", max_line_size, HTTPStatus.BAD_REQUEST)
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid chunk size")
+        if size == 0:
+            break
+        if len(body) + size > max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        offset = len(body)
+        body.extend(bytes(size))
+        connection.read_into(body, offset, size)
+        if connection.read_until(b"\r\n", 2, HTTPStatus.BAD_REQUEST) != b"":
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing chunk delimiter")
+    # Trailer fields are not used, read them up to the empty line
+    while connection.read_until(b"\r\n", max_line_size, HTTPStatus.BAD_REQUEST):
+        pass
+    return body
+
+
+# Function to send a complete response, the body is bytes or str
+def send_response(connection, status, body=b"", keep_alive=True, content_type="text/plain; charset=utf-8", headers=None):
+    if isinstance(body, str):
+        body = body.encode()
+    status = HTTPStatus(status)
+    headers = dict(headers or {})
+    content_type = headers.pop("Content-Type", content_type)
+    head = [
+        f"HTTP/1.1 {status.value} {status.phrase}",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}"
+    ]
+    if body:
+        head.append(f"Content-Type: {content_type}")
+    for name, value in headers.items():
+        head.append(f"{name}: {value}")
+    connection.send(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+# Class with the listening socket and idle keep-alive connections watched by one selector thread
+# Connections with data are handed to a worker pool, a worker serves requests until the connection is idle again
+class HTTPServer:
+    def __init__(self, address, handler, pool, backlog=128, client_timeout=30, keepalive_timeout=75,
+                 max_body_size=1048576):
+        self._handler = handler  # Takes HTTPRequest, returns (status, body) or (status, body, headers)
+        self._pool = pool
+        self._client_timeout = client_timeout  # Seconds to wait for the rest of a started request
+        self._keepalive_timeout = keepalive_timeout  # Seconds an idle connection is kept open
+        self._max_body_size = max_body_size
+        self._selector = selectors.DefaultSelector()
+        self._returned = queue.SimpleQueue()  # Connections given back by workers after a response
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._closing = False
+        self._closing_lock = threading.Lock()  # Connections are not given back after _shutdown() took the last ones
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(address)
+        self.server_socket.listen(backlog)
+        self.server_socket.setblocking(False)
+
+    # Function to run the selector loop until stop_event is set
+    def serve(self, stop_event):
+        self._selector.register(self.server_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+        while not stop_event.is_set():
+            # Wake up every second to check if shutdown was requested and to close idle connections
+            for key, _ in self._selector.select(timeout=1):
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                elif key.fileobj is self._wakeup_receiver:
+                    self._take_returned()
+                else:
+                    # Data arrived on an idle connection, a worker reads and answers the request
+                    self._selector.unregister(key.fileobj)
+                    self._pool.submit(self.serve_connection, key.data)
+            self._close_idle(self._keepalive_timeout)
+        self._shutdown()
+
+    def _accept(self):
+        while True:
+            try:
+                client_socket, client_addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error(f"Accepting connection failed with error: {e}")
+                return
+            client_socket.setblocking(True)
+            client_socket.settimeout(self._client_timeout)
+            logging.debug("Connection from %s", client_addr)
+            self._selector.register(client_socket, selectors.EVENT_READ, HTTPConnection(client_socket, client_addr))
+
+    def _take_returned(self):
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                connection = self._returned.get_nowait()
+            except queue.Empty:
+                return
+            if self._closing:
+                connection.close()
+            else:
+                self._selector.register(connection.socket, selectors.EVENT_READ, connection)
+
+    def _close_idle(self, timeout):
+        now = time.monotonic()
+        for key in list(self._selector.get_map().values()):
+            connection = key.data
+            if connection is not None and now - connection.last_active >= timeout:
+                self._selector.unregister(key.fileobj)
+                connection.close()
+
+    def _shutdown(self):
+        with self._closing_lock:
+            self._closing = True
+        # Connections already waiting in the backlog are served, so they are not reset on close
+        self._accept()
+        self._selector.unregister(self.server_socket)
+        self.server_socket.close()
+        self._take_returned()
+        for key in list(self._selector.get_map().values()):
+            connection = key.data
+            if connection is None:
+                continue
+            self._selector.unregister(key.fileobj)
+            if connection.requests:
+                connection.close()  # Idle keep-alive connection between two requests
+            else:
+                self._pool.submit(self.serve_connection, connection)
+
+    # Function to serve requests from one connection in a worker thread
+    def serve_connection(self, connection):
+        try:
+            while True:
+                try:
+                    request = read_request(connection, max_body_size=self._max_body_size)
+                except ConnectionClosed:
+                    connection.close()
+                    return
+                except socket.timeout:
+                    if connection.buffer:
+                        send_response(connection, HTTPStatus.REQUEST_TIMEOUT, keep_alive=False)
+                    connection.close()
+                    return
+                except HTTPError as e:
+                    logging.error(f"Invalid request from {connection.addr}: {e}")
+                    send_response(connection, e.status, str(e), keep_alive=False)
+                    connection.close()
+                    return
+                response = self._handler(request)
+                status, body = response[0], response[1]
+                headers = response[2] if len(response) > 2 else None
+                keep_alive = request.keep_alive and not self._closing
+                send_response(connection, status, body, keep_alive=keep_alive, headers=headers)
+                connection.requests += 1
+                if not keep_alive:
+                    connection.close()
+                    return
+                # Pipelined requests are already in the buffer and are answered right away
+                if not connection.buffer:
+                    break
+        except Exception as e:
+            logging.error(f"Error while serving connection from {connection.addr}: {e}")
+            connection.close()
+            return
+        # After shutdown nobody takes returned connections any more, the worker closes them
+        with self._closing_lock:
+            returned = not self._closing
+            if returned:
+                self._returned.put(connection)
+        if not returned:
+            connection.close()
+            return
+        try:
+            self._wakeup_sender.send(b"\0")
+        except OSError:
+            connection.close()
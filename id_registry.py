@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from zabbix_api import ZabbixAPIError
+
+
+# Class with name -> ID lookups for one kind of Zabbix object (templates, host groups, proxies)
+# Unknown names are resolved with one get request, entries expire after ttl seconds
+class IdRegistry:
+    def __init__(self, client, kind, id_field, filter_field="name", create_missing=False, ttl=3600, negative_ttl=60):
+        self._client = client
+        self.kind = kind  # API object name, "template" for template.get
+        self._id_field = id_field
+        self._filter_field = filter_field  # Field the names are searched by, templates are searched by "host"
+        self._create_missing = create_missing  # Create objects Zabbix does not know (only for host groups)
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl  # Seconds before a name Zabbix does not know is searched again
+        self._ids = {}  # name -> (id, expiry time)
+        self._missing = {}  # name -> expiry time
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+    # Function to build the get request for some names (or all objects), so it can be sent in a batch
+    def lookup_call(self, names=None):
+        params = {"output": list(dict.fromkeys([self._id_field, "name", self._filter_field]))}
+        if names is not None:
+            params["filter"] = {self._filter_field: list(names)}
+        return (f"{self.kind}.get", params)
+
+    # Function to save the result of a get request, requested names that were not returned are remembered as missing
+    def store(self, objects, requested=()):
+        now = time.monotonic()
+        with self._lock:
+            for item in objects:
+                for field in {"name", self._filter_field}:
+                    if item.get(field):
+                        self._ids[item[field]] = (item[self._id_field], now + self._ttl)
+                        self._missing.pop(item[field], None)
+            for name in requested:
+                if name not in self._ids or self._ids[name][1] <= now:
+                    self._missing[name] = now + self._negative_ttl
+
+    # Function to return the ID of one name, or None if it can not be resolved
+    def get(self, name):
+        return self.resolve([name]).get(name)
+
+    # Function to return a name -> ID dictionary, names that can not be resolved are left out
+    def resolve(self, names):
+        names = list(dict.fromkeys(names))
+        now = time.monotonic()
+        misses = []
+        with self._lock:
+            for name in names:
+                entry = self._ids.get(name)
+                if entry is not None and entry[1] > now:
+                    continue
+                if self._missing.get(name, 0) > now and not self._create_missing:
+                    continue
+                misses.append(name)
+        if misses:
+            # All unknown and expired names are searched with one request
+            method, params = self.lookup_call(misses)
+            try:
+                self.store(self._client.call(method, params), misses)
+            except ZabbixAPIError as e:
+                # Expired IDs are still used below, they are very likely still valid
+                logging.warning(f"Request for {self.kind} IDs of {misses} failed with error: {e}")
+            else:
+                if self._create_missing:
+                    with self._lock:
+                        unknown = [name for name in misses if name not in self._ids]
+                    self._create(unknown)
+        with self._lock:
+            return {name: self._ids[name][0] for name in names if name in self._ids}
+
+    def _create(self, names):
+        if not names:
+            return
+        try:
+            result = self._client.call(f"{self.kind}.create", [{"name": name} for name in names])
+        except ZabbixAPIError as e:
+            logging.error(f"Creation of {self.kind} {names} failed with error: {e}")
+            return
+        self.store([{self._id_field: object_id, "name": name} for name, object_id in zip(names, result[f"{self._id_field}s"])])
+        logging.info(f"Created missing {self.kind} objects: {', '.join(names)}")
+
+    # Function to return all names with an ID, used to refresh them before they expire
+    def names(self):
+        with self._lock:
+            return list(self._ids)
+
+    # Function to return the name -> ID entries for the cache snapshot
+    def snapshot(self):
+        with self._lock:
+            return {name: object_id for name, (object_id, _) in self._ids.items()}
+
+    # Function to load entries from the cache snapshot, they are replaced by the next get request
+    def load_snapshot(self, ids):
+        self.store([{self._id_field: object_id, "name": name} for name, object_id in ids.items()])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from metrics import Counter
+
+# Logging settings, can be overridden with environmental variables
+log_path = os.environ.get("ZABBIX_SUITE_LOG_FILE", "logs/zabbix_automation_suite.log")
+log_level = os.environ.get("ZABBIX_SUITE_LOG_LEVEL", "INFO").upper()
+log_format = os.environ.get("ZABBIX_SUITE_LOG_FORMAT", "json").lower()  # "json" or "text"
+log_max_bytes = int(os.environ.get("ZABBIX_SUITE_LOG_MAX_BYTES", 50 * 1024 * 1024))  # Size before the log file is rotated
+log_backups = int(os.environ.get("ZABBIX_SUITE_LOG_BACKUPS", 5))  # Rotated files kept
+log_queue_size = int(os.environ.get("ZABBIX_SUITE_LOG_QUEUE_SIZE", 10000))  # Records waiting for the writer thread
+debug_dumps_per_minute = int(os.environ.get("ZABBIX_SUITE_DEBUG_DUMPS_PER_MINUTE", 10))
+
+# Correlation id of the webhook handled by the current thread, added to every record
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+dropped_records = Counter("zabbix_suite_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+# Argument types that can be formatted later in the writer thread, other objects may change before that
+immutable_types = (str, int, float, bool, type(None))
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+# Function to return a new correlation id, short enough to search for in the log
+def new_correlation_id():
+    return uuid.uuid4().hex[:12]
+
+
+# Function to set the correlation id for the records written inside the block
+@contextmanager
+def correlation(value):
+    token = correlation_id.set(value)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+# Class with a record as one JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        if record.name != "root":
+            entry["logger"] = record.name
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+
+# Class with the text format used before, with the correlation id at the end of the line
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        correlation = getattr(record, "correlation_id", None)
+        return f"{message} [{correlation}]" if correlation else message
+
+
+# Class that hands records to the writer thread without waiting, records are dropped when the queue is full
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record.correlation_id = correlation_id.get()
+        # Tracebacks are rendered now, the frames are gone when the writer thread gets the record
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        # Messages with only immutable arguments are formatted by the writer thread
+        if record.args and not all(isinstance(arg, immutable_types) for arg in
+                                   (record.args if isinstance(record.args, tuple) else record.args.values())):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+# Function to send all records of the process through a queue to a rotating log file written by one thread
+def setup_logging(path=log_path, level=log_level):
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=log_max_bytes, backupCount=log_backups)
+        if log_format == "text":
+            file_handler.setFormatter(TextFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+        else:
+            file_handler.setFormatter(JsonFormatter())
+        log_queue = queue.Queue(maxsize=log_queue_size)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(NonBlockingQueueHandler(log_queue))
+        root.setLevel(level)
+        _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+
+# Function to write the records still in the queue, called at exit
+def stop_logging():
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+# Class that lets through a limited number of big debug dumps per minute
+class DumpSampler:
+    def __init__(self, per_minute=debug_dumps_per_minute):
+        self._per_minute = per_minute
+        self._window_start = 0
+        self._count = 0
+        self._skipped = 0
+        self._lock = threading.Lock()
+
+    # Function to log a debug dump if debug logging is on and the limit is not reached
+    # Arguments are only formatted when the dump is written
+    def dump(self, message, *args):
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 60:
+                skipped = self._skipped
+                self._window_start, self._count, self._skipped = now, 0, 0
+            else:
+                skipped = 0
+            if self._count >= self._per_minute:
+                self._skipped += 1
+                return
+            self._count += 1
+        if skipped:
+            logging.debug("%d debug dumps skipped in the last minute", skipped)
+        logging.debug(message, *args)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached lookup to a slow playbook run
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# Function to escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Class with all metrics of the process, rendered in the Prometheus text format for /metrics
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# Class with a counter per label values, or one counter read from a function at every scrape
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self._labelnames = tuple(labelnames)
+        self._function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    # Function to return the sum of the counter over all label values
+    def total(self):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self):
+        if self._function is not None:
+            return [f"{self.name} {self._function()}"]
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self._labelnames, labels)} {value}" for labels, value in values]
+
+
+# Class with a gauge per label values, or gauges read from a function at every scrape
+# With label names the function returns {label values: value}
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self._labelnames = tuple(labelnames)
+        self._function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    # Function to count a block of code as in progress while it runs
+    @contextmanager
+    def track(self, *labels):
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+    def samples(self):
+        if self._function is not None and not self._labelnames:
+            return [f"{self.name} {self._function()}"]
+        if self._function is not None:
+            values = list(self._function().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [f"{self.name}{format_labels(self._labelnames, labels)} {value}" for labels, value in values]
+
+
+# Class with a latency histogram per label values
+# Observations only add to one bucket under the lock, cumulative counts are computed at scrape time
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self._labelnames = tuple(labelnames)
+        self._buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self._buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    # Function to observe the time a block of code takes
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_label = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self._labelnames, labels, [bucket_label])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self._labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self._labelnames, labels)} {cumulative}")
+        return lines
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from zabbix_api import ZabbixAPIError
+
+
+# Class with the Zabbix proxies, their load and the proxy groups from the classification rules
+# New hosts of a group go to the proxy with the fewest hosts per unit of capacity
+class ProxyRegistry:
+    kind = "proxy"
+
+    def __init__(self, client):
+        self._client = client
+        self._groups = {}  # group name -> {proxy name: capacity}
+        self._proxies = {}  # proxy name -> proxy ID
+        self._hosts = {}  # proxy ID -> monitored hosts, counted by Zabbix and increased by commit()
+        self._pending = {}  # proxy ID -> hosts chosen by select() that are being created
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._proxies)
+
+    # Function to replace the proxy groups, called when the classification rules are loaded
+    def set_groups(self, groups):
+        with self._lock:
+            self._groups = {name: dict(proxies) for name, proxies in groups.items()}
+
+    # Function to build the proxy.get request with the hosts of every proxy, so it can be sent in a batch
+    # Zabbix up to 6.2 has no required performance per proxy in the API, the load is the number of hosts
+    def lookup_call(self, names=None):
+        return ("proxy.get", {"output": ["proxyid", "host"], "selectHosts": ["hostid"]})
+
+    # Function to save the result of proxy.get, the counts of commit() since the last request are replaced, pending hosts are kept
+    def store(self, proxies, requested=()):
+        with self._lock:
+            self._proxies = {proxy["host"]: proxy["proxyid"] for proxy in proxies}
+            self._hosts = {proxy["proxyid"]: len(proxy.get("hosts", [])) for proxy in proxies}
+            unknown = {group: [name for name in members if name not in self._proxies] for group, members in self._groups.items()}
+        for group, names in unknown.items():
+            if names:
+                logging.warning(f"Proxies {names} of proxy group {group} do not exist in Zabbix")
+
+    # Function to read the proxies and their hosts from Zabbix again
+    def refresh(self):
+        method, params = self.lookup_call()
+        try:
+            self.store(self._client.call(method, params))
+        except ZabbixAPIError as e:
+            logging.warning(f"Request for proxy load failed with error: {e}")
+            return False
+        logging.info(f"Hosts per proxy: {self.load()}")
+        return True
+
+    # Function to refresh the proxy load in the background until stop_event is set
+    def start_refresh(self, interval, stop_event):
+        def refresh_loop():
+            while not stop_event.wait(interval):
+                self.refresh()
+        threading.Thread(target=refresh_loop, name="proxy-refresh", daemon=True).start()
+
+    # Function to pick the least loaded proxy of a group for a new host, returns (proxy ID, proxy name)
+    # The host is pending until commit() or release(), so hosts created at the same time are spread over the group
+    def select(self, group):
+        with self._lock:
+            members = self._groups.get(group)
+            if members is None:
+                raise KeyError(f"Unknown proxy group: {group}")
+            candidates = [((self._hosts.get(self._proxies[name], 0) + self._pending.get(self._proxies[name], 0)) / capacity, name)
+                          for name, capacity in members.items() if name in self._proxies]
+            if not candidates:
+                raise KeyError(f"No proxy of group {group} exists in Zabbix")
+            name = min(candidates)[1]
+            proxyid = self._proxies[name]
+            self._pending[proxyid] = self._pending.get(proxyid, 0) + 1
+            return proxyid, name
+
+    # Function to count a host on the proxy chosen by select() once it was created
+    # Hosts created before the next refresh count toward the proxy load
+    def commit(self, proxyid):
+        with self._lock:
+            if self._pending.get(proxyid):
+                self._pending[proxyid] -= 1
+                self._hosts[proxyid] = self._hosts.get(proxyid, 0) + 1
+
+    # Function to drop the choice of select() when the host was not created
+    def release(self, proxyid):
+        with self._lock:
+            if self._pending.get(proxyid):
+                self._pending[proxyid] -= 1
+
+    # Function to return the proxies and their hosts for the cache snapshot
+    def snapshot(self):
+        with self._lock:
+            return [{"proxyid": proxyid, "host": name, "host_count": self._hosts.get(proxyid, 0)} for name, proxyid in self._proxies.items()]
+
+    # Function to load the proxies from the cache snapshot, they are replaced by the next proxy.get request
+    def load_snapshot(self, proxies):
+        with self._lock:
+            self._proxies = {proxy["host"]: proxy["proxyid"] for proxy in proxies}
+            self._hosts = {proxy["proxyid"]: proxy["host_count"] for proxy in proxies}
+
+    # Function to return the hosts of every proxy by group, for the log and /metrics
+    def load(self):
+        with self._lock:
+            return {group: {name: self._hosts.get(self._proxies.get(name), 0) for name in members}
+                    for group, members in self._groups.items()}
+
+    # Function to return the capacity of every proxy by group, for /metrics
+    def capacity(self):
+        with self._lock:
+            return {group: dict(members) for group, members in self._groups.items()}
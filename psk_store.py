@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+# File with the PSKs of all hosts, readable only by the service user
+psk_store_path = os.environ.get("ZABBIX_SUITE_PSK_STORE", "auth/psk_store.db")
+
+schema = """
+CREATE TABLE IF NOT EXISTS psk (
+    host TEXT PRIMARY KEY,
+    hostid TEXT,
+    serial INTEGER NOT NULL,  -- Serial of the current key, 0 before the first key was confirmed
+    identity TEXT,
+    psk TEXT,
+    pending_identity TEXT,
+    pending_psk TEXT,
+    previous_identity TEXT,
+    previous_psk TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS psk_hostid ON psk (hostid);
+"""
+columns = ("host", "hostid", "serial", "identity", "psk", "pending_identity", "pending_psk", "previous_identity", "previous_psk", "updated")
+
+
+# Function to return a new 256 bit PSK as 64 hex characters, from the CSPRNG of the operating system
+def generate_psk():
+    return secrets.token_hex(32)
+
+
+# Function to return the PSK identity of a host, the serial is increased with every new key
+def psk_identity(host_name, serial):
+    return f"{host_name}-PSK{serial:02d}"
+
+
+# Class with the PSK of every Zabbix host in SQLite, by host name and host ID
+# A new key is stored as pending before it is sent to Zabbix and becomes the current key when Zabbix accepted it,
+# so a key is never in Zabbix without being in the store. A pending key that is not confirmed had a request with an unknown result.
+class PskStore:
+    def __init__(self, path=psk_store_path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # The file is created with mode 0600, the keys are never readable by other users
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(schema)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM psk").fetchone()[0]
+
+    # Function to generate new keys for hosts and store them as pending, returns {host name: (identity, psk)}
+    # All keys are written in one transaction, before any of them is sent to Zabbix
+    # first_serial is used for hosts that are not in the store, 2 for hosts created with -PSK01 before the store existed
+    def stage(self, host_names, first_serial=1):
+        now = time.time()
+        keys = {}
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for host_name in dict.fromkeys(host_names):
+                    row = self._db.execute("SELECT serial FROM psk WHERE host = ?", (host_name,)).fetchone()
+                    serial = row[0] + 1 if row else first_serial
+                    keys[host_name] = (psk_identity(host_name, serial), generate_psk())
+                    self._db.execute(
+                        "INSERT INTO psk (host, serial, pending_identity, pending_psk, updated) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT (host) DO UPDATE SET pending_identity = excluded.pending_identity, "
+                        "pending_psk = excluded.pending_psk, updated = excluded.updated",
+                        (host_name, serial - 1, *keys[host_name], now))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+        return keys
+
+    # Function to make the pending keys of hosts accepted by Zabbix their current keys, takes {host name: host ID or None}
+    # The replaced key is kept as the previous key until the next rotation
+    def confirm(self, hostids):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for host_name, hostid in hostids.items():
+                    self._db.execute(
+                        "UPDATE psk SET hostid = COALESCE(?, hostid), previous_identity = identity, previous_psk = psk, "
+                        "identity = pending_identity, psk = pending_psk, serial = serial + 1, "
+                        "pending_identity = NULL, pending_psk = NULL, updated = ? "
+                        "WHERE host = ? AND pending_psk IS NOT NULL", (hostid, now, host_name))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # Function to move the keys of renamed hosts to their new names, takes {host ID: new host name}
+    # A row that still has the new name belongs to a host renamed outside the suite, or deleted, and may still be in use
+    # It is kept under "<name>#<host ID>", so its key can still be exported
+    def rename(self, host_names):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for hostid, host_name in host_names.items():
+                    if self._db.execute("SELECT 1 FROM psk WHERE hostid = ?", (hostid,)).fetchone() is None:
+                        continue
+                    other = self._db.execute("SELECT rowid, hostid FROM psk WHERE host = ? AND hostid IS NOT ?", (host_name, hostid)).fetchone()
+                    if other:
+                        kept_name = f"{host_name}#{other[1] or other[0]}"
+                        self._db.execute("UPDATE psk SET host = ? WHERE rowid = ?", (kept_name, other[0]))
+                        logging.warning(f"Stored PSK of another host named {host_name} kept as {kept_name}, the name now belongs to host {hostid}")
+                    self._db.execute("UPDATE psk SET host = ?, updated = ? WHERE hostid = ?", (host_name, now, hostid))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # Function to return the stored keys of a host, or None if the host is not in the store
+    def get(self, host_name):
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(columns)} FROM psk WHERE host = ?", (host_name,)).fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    # Function to return the stored keys of all hosts, or of the given hosts, ordered by host name
+    def entries(self, host_names=None):
+        with self._lock:
+            rows = self._db.execute(f"SELECT {', '.join(columns)} FROM psk ORDER BY host").fetchall()
+        wanted = set(host_names) if host_names else None
+        return [dict(zip(columns, row)) for row in rows if wanted is None or row[0] in wanted]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
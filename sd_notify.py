@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import socket
+
+
+# Function to send a state change to systemd (Type=notify), does nothing when not started by systemd
+# Messages are "READY=1", "STOPPING=1" or "STATUS=<text>", see sd_notify(3)
+def notify(message):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    # Abstract namespace sockets start with "@"
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.connect(address)
+            notify_socket.sendall(message.encode())
+    except OSError as e:
+        logging.warning(f"Notification {message!r} to systemd failed: {e}")
+        return False
+    return True
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY,
+    key TEXT,
+    payload TEXT NOT NULL,
+    received REAL NOT NULL,
+    not_before REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    collapsed INTEGER NOT NULL DEFAULT 0,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    correlation_id TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS queue_waiting_key ON queue (key) WHERE claimed = 0;
+CREATE INDEX IF NOT EXISTS queue_due ON queue (claimed, not_before);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    id INTEGER PRIMARY KEY,
+    key TEXT,
+    payload TEXT NOT NULL,
+    received REAL NOT NULL,
+    failed REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    correlation_id TEXT
+);
+"""
+
+
+# Class with webhooks stored in SQLite until they are processed
+# Entries with the same key are collapsed while they wait, only the latest payload is kept
+class WorkQueue:
+    def __init__(self, path, max_attempts=8, retry_base=5, retry_max=600):
+        self.path = path
+        self._max_attempts = max_attempts  # Failed attempts before an entry is moved to dead_letter
+        self._retry_base = retry_base  # Seconds before the first retry, doubled with every attempt
+        self._retry_max = retry_max
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        os.chmod(path, 0o600)
+        # WAL with synchronous=NORMAL survives a crash of the process, commits do not wait for fsync of the database
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(schema)
+        # Queues created before correlation ids were stored get the column
+        for table in ("queue", "dead_letter"):
+            if "correlation_id" not in [column[1] for column in self._db.execute(f"PRAGMA table_info({table})")]:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN correlation_id TEXT")
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._closed = False
+        # Counted since the queue was opened
+        self.received = 0  # Webhooks stored with put()
+        self.collapsed = 0  # Webhooks replaced by a newer one of the same key while they waited
+        self.dispatched = 0  # Entries given out by claim(), retries included
+
+    # Function to give out the entries claimed by a process that died again
+    # Only called by the service at start, other processes open the queue while the service is running
+    def replay_claimed(self):
+        with self._lock:
+            replayed = self._db.execute("UPDATE queue SET claimed = 0 WHERE claimed = 1").rowcount
+            pending = self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+        if pending:
+            logging.info(f"Work queue {self.path} opened with {pending} pending entries, {replayed} of them were in progress")
+
+    # Function to store one payload, it is given out after delay seconds
+    # A waiting entry with the same key gets the new payload and correlation id and keeps its place
+    # An entry waiting for a retry is a new webhook then, it gets new attempts and is not given out later than one
+    def put(self, key, payload, delay=0, correlation_id=None):
+        now = time.time()
+        with self._available:
+            waiting = key is not None and self._db.execute(
+                "SELECT 1 FROM queue WHERE key = ? AND claimed = 0", (key,)).fetchone() is not None
+            self._db.execute(
+                "INSERT INTO queue (key, payload, received, not_before, correlation_id) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) WHERE claimed = 0 DO UPDATE SET payload = excluded.payload, "
+                "correlation_id = excluded.correlation_id, collapsed = collapsed + 1, attempts = 0, last_error = NULL, "
+                "not_before = MIN(not_before, excluded.not_before)",
+                (key, json.dumps(payload), now, now + delay, correlation_id))
+            self.received += 1
+            self.collapsed += waiting
+            self._available.notify()
+
+    # Function to claim up to limit due entries, waits up to timeout seconds for one
+    # Returns a list of (id, key, payload, attempts, received, correlation_id)
+    def claim(self, limit, timeout=1):
+        deadline = time.monotonic() + timeout
+        with self._available:
+            while not self._closed:
+                now = time.time()
+                rows = self._db.execute(
+                    "SELECT id, key, payload, attempts, received, correlation_id FROM queue WHERE claimed = 0 AND not_before <= ? "
+                    "ORDER BY not_before LIMIT ?", (now, limit)).fetchall()
+                if rows:
+                    self._db.executemany("UPDATE queue SET claimed = 1 WHERE id = ?", [(row[0],) for row in rows])
+                    self.dispatched += len(rows)
+                    return [(entry_id, key, json.loads(payload), attempts, received, correlation_id)
+                            for entry_id, key, payload, attempts, received, correlation_id in rows]
+                next_due = self._db.execute("SELECT MIN(not_before) FROM queue WHERE claimed = 0").fetchone()[0]
+                wait = deadline - time.monotonic()
+                if next_due is not None:
+                    wait = min(wait, next_due - now)
+                if deadline <= time.monotonic():
+                    return []
+                self._available.wait(max(wait, 0.01))
+        return []
+
+    # Function to remove a processed entry
+    def ack(self, entry_id):
+        with self._lock:
+            self._db.execute("DELETE FROM queue WHERE id = ?", (entry_id,))
+
+    # Function to schedule a retry of a failed entry, or move it to dead_letter after max_attempts
+    # With a delay the entry is retried after it without counting an attempt, used while Zabbix is unavailable
+    def fail(self, entry_id, error, delay=None):
+        with self._available:
+            row = self._db.execute(
+                "SELECT key, payload, received, attempts, correlation_id FROM queue WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return
+            key, payload, received, attempts, entry_correlation_id = row
+            if delay is None:
+                attempts += 1
+            newer = key is not None and self._db.execute(
+                "SELECT 1 FROM queue WHERE key = ? AND claimed = 0", (key,)).fetchone()
+            self._db.execute("BEGIN")
+            try:
+                if newer:
+                    # A newer webhook of the same key is waiting, it replaces the failed one
+                    self._db.execute("DELETE FROM queue WHERE id = ?", (entry_id,))
+                    message = (logging.INFO, f"Failed entry {key} dropped, a newer entry of the same key is waiting")
+                elif delay is None and attempts >= self._max_attempts:
+                    self._db.execute(
+                        "INSERT INTO dead_letter (key, payload, received, failed, attempts, last_error, correlation_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, payload, received, time.time(), attempts, str(error), entry_correlation_id))
+                    self._db.execute("DELETE FROM queue WHERE id = ?", (entry_id,))
+                    message = (logging.ERROR, f"Entry {key} moved to dead_letter after {attempts} attempts, last error: {error}")
+                elif delay is not None:
+                    self._db.execute("UPDATE queue SET claimed = 0, not_before = ?, last_error = ? WHERE id = ?",
+                                     (time.time() + delay, str(error), entry_id))
+                    message = (logging.WARNING, f"Entry {key} deferred for {delay:.0f}s: {error}")
+                else:
+                    # Exponential backoff with jitter, so entries failed together are not retried together
+                    delay = min(self._retry_base * 2 ** (attempts - 1), self._retry_max) * random.uniform(0.5, 1)
+                    self._db.execute(
+                        "UPDATE queue SET claimed = 0, attempts = ?, not_before = ?, last_error = ? WHERE id = ?",
+                        (attempts, time.time() + delay, str(error), entry_id))
+                    message = (logging.WARNING, f"Entry {key} failed (attempt {attempts} of {self._max_attempts}), retry in {delay:.0f}s: {error}")
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+            self._available.notify()
+        logging.log(*message)
+
+    # Function to give a claimed entry out again, used when its result could not be stored
+    # The entry is dropped if a newer entry of the same key is waiting
+    def release(self, entry_id):
+        with self._available:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("DELETE FROM queue WHERE id = ? AND key IN (SELECT key FROM queue WHERE claimed = 0)", (entry_id,))
+                self._db.execute("UPDATE queue SET claimed = 0 WHERE id = ?", (entry_id,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+            self._available.notify()
+
+    # Function to move dead entries back to the queue with new attempts, returns the number of entries
+    # A dead entry is dropped if a newer entry of the same key is waiting
+    def requeue_dead(self):
+        with self._available:
+            self._db.execute("BEGIN")
+            try:
+                rows = self._db.execute("SELECT id, key, payload, received, correlation_id FROM dead_letter").fetchall()
+                for dead_id, key, payload, received, dead_correlation_id in rows:
+                    self._db.execute(
+                        "INSERT INTO queue (key, payload, received, not_before, correlation_id) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT (key) WHERE claimed = 0 DO NOTHING", (key, payload, received, time.time(), dead_correlation_id))
+                    self._db.execute("DELETE FROM dead_letter WHERE id = ?", (dead_id,))
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+            self._available.notify()
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            depth, in_progress, oldest = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(claimed), 0), MIN(received) FROM queue").fetchone()
+            dead = self._db.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+            return {
+                "depth": depth,
+                "in_progress": in_progress,
+                "oldest_age_seconds": round(time.time() - oldest, 1) if oldest is not None else 0,
+                "dead_letter": dead,
+                "received": self.received,
+                "collapsed": self.collapsed,
+                "dispatched": self.dispatched
+            }
+
+    # Function to wake up waiting claim() calls and stop giving out entries
+    def close(self):
+        with self._available:
+            self._closed = True
+            self._available.notify_all()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# Class to serialize processing of the same host (IP address or VM id) across worker threads
+class KeyedLocks:
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # key -> [lock, number of threads holding or waiting for it]
+
+    @contextmanager
+    def hold(self, *keys):
+        # Keys are always taken in sorted order, so two workers can never deadlock each other
+        keys = sorted(set(keys))
+        acquired = []
+        try:
+            for key in keys:
+                with self._guard:
+                    entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                    entry[1] += 1
+                entry[0].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                with self._guard:
+                    entry = self._locks[key]
+                    entry[0].release()
+                    entry[1] -= 1
+                    # Drop the lock once nobody needs it, so the dictionary does not grow forever
+                    if entry[1] == 0:
+                        del self._locks[key]
+
+
+# Class with a bounded pool of worker threads that can be drained on shutdown
+class WorkerPool:
+    def __init__(self, max_workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="webhook")
+        # Running plus queued jobs; submit() blocks when the limit is reached
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def submit(self, function, *args):
+        self._slots.acquire()
+        with self._idle:
+            self._in_flight += 1
+        try:
+            return self._executor.submit(self._run, function, *args)
+        except Exception:
+            self._job_done()
+            raise
+
+    def in_flight(self):
+        with self._idle:
+            return self._in_flight
+
+    def _run(self, function, *args):
+        try:
+            return function(*args)
+        finally:
+            self._job_done()
+
+    def _job_done(self):
+        with self._idle:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.notify_all()
+        self._slots.release()
+
+    # Function to wait for running and queued jobs, returns False if the timeout expired first
+    def drain(self, timeout):
+        with self._idle:
+            drained = self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+        self._executor.shutdown(wait=drained, cancel_futures=not drained)
+        return drained
+
+
+# Class to collect items from concurrent threads and process them together with one call
+class Batcher:
+    def __init__(self, flush_function, max_size, window):
+        self._flush_function = flush_function  # Takes a list of items, returns a list of results in the same order
+        self._max_size = max_size
+        self._window = window  # Seconds the first item of a batch waits for others
+        self._batch_ready = threading.Condition()
+        self._batch = None
+
+    # Function to add an item to the current batch and wait for its result
+    def submit(self, item):
+        future = Future()
+        with self._batch_ready:
+            # The thread that opens a batch is the one that sends it
+            leader = self._batch is None or len(self._batch) >= self._max_size
+            if leader:
+                self._batch = []
+            batch = self._batch
+            batch.append((item, future))
+            if len(batch) >= self._max_size:
+                self._batch_ready.notify_all()
+            if leader:
+                self._batch_ready.wait_for(lambda: len(batch) >= self._max_size, self._window)
+                if self._batch is batch:
+                    self._batch = None
+        if leader:
+            try:
+                results = self._flush_function([batch_item for batch_item, _ in batch])
+                for (_, batch_future), result in zip(batch, results):
+                    batch_future.set_result(result)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Batch of {len(batch)} items returned {len(results)} results")
+            except Exception as e:
+                for _, batch_future in batch:
+                    if not batch_future.done():
+                        batch_future.set_exception(e)
+        return future.result()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from api_governor import AdaptiveLimiter, CircuitBreaker
+from metrics import Counter, Gauge, Histogram
+
+zabbix_url = os.environ.get("ZABBIX_URL", "https://hetzner-monitor.wee.co.il/zabbix/api_jsonrpc.php")  # Benchmarks point it to benchmarks/fake_zabbix.py
+
+# Pool size matches the number of workers, so every worker can keep its own connection open
+pool_size = int(os.environ.get("ZABBIX_SUITE_WORKERS", 16))
+request_timeout = int(os.environ.get("ZABBIX_SUITE_API_TIMEOUT", 30))  # Seconds to wait for Zabbix API response
+
+# Outbound limits, the concurrency limit is lowered when Zabbix slows down and raised again when it recovers
+api_max_concurrency = int(os.environ.get("ZABBIX_SUITE_API_MAX_CONCURRENCY", pool_size))  # Concurrent HTTP requests
+api_min_concurrency = int(os.environ.get("ZABBIX_SUITE_API_MIN_CONCURRENCY", 2))  # The limit is never lowered below this
+api_max_rate = float(os.environ.get("ZABBIX_SUITE_API_MAX_RATE", 200))  # API calls per second, batch entries included, 0 for no limit
+api_latency_target = float(os.environ.get("ZABBIX_SUITE_API_LATENCY_TARGET", 2))  # Slower requests lower the concurrency limit
+api_retries = int(os.environ.get("ZABBIX_SUITE_API_RETRIES", 2))  # Retries of read calls after connection errors
+api_retry_base = float(os.environ.get("ZABBIX_SUITE_API_RETRY_BASE", 0.5))  # Maximum seconds before the first retry, doubled with every retry
+# After this number of failed requests in a row calls are rejected without a request, one test request is sent every cooldown
+breaker_failures = int(os.environ.get("ZABBIX_SUITE_BREAKER_FAILURES", 5))
+breaker_cooldown = float(os.environ.get("ZABBIX_SUITE_BREAKER_COOLDOWN", 30))
+
+# Batch requests are measured as method "batch", their calls are counted by method in api_calls
+api_latency = Histogram("zabbix_suite_api_request_seconds", "Duration of Zabbix API HTTP requests", ["method"])
+api_calls = Counter("zabbix_suite_api_calls_total", "Zabbix API calls sent, batch entries included", ["method"])
+api_errors = Counter("zabbix_suite_api_errors_total", "Zabbix API calls that failed", ["method", "kind"])
+api_in_flight = Gauge("zabbix_suite_api_requests_in_flight", "Zabbix API HTTP requests waiting for a response")
+api_retried = Counter("zabbix_suite_api_retries_total", "Zabbix API requests sent again after connection errors", ["method"])
+
+
+# Exception for errors returned by the Zabbix API
+class ZabbixAPIError(Exception):
+    def __init__(self, message, code=None, data=None, method=None):
+        super().__init__(f"{method}: {message} {data or ''}".strip() if method else message)
+        self.code = code
+        self.data = data
+        self.method = method
+
+
+# Exception for failed connections, HTTP errors and responses that are not JSON-RPC
+class ZabbixConnectionError(ZabbixAPIError):
+    pass
+
+
+# Exception for calls rejected without a request while the circuit breaker is open
+class ZabbixUnavailableError(ZabbixConnectionError):
+    pass
+
+
+# Function to check if an error means the session token expired or was logged out
+def is_session_error(error):
+    text = f"{error.data or ''} {error}".lower()
+    return any(message in text for message in ("re-login", "session terminated", "not authorised", "not authorized"))
+
+
+# Function to check if a call only reads data, so it can be sent again after a connection error
+def is_read_method(method):
+    return method.endswith(".get") or method in ("apiinfo.version", "user.checkAuthentication")
+
+
+# Class with one keep-alive HTTP session shared by all Zabbix API calls of the process
+# Requests go through the limiter and the circuit breaker, read calls are retried after connection errors
+class ZabbixAPI:
+    def __init__(self, url, pool_size=16, timeout=30, limiter=None, breaker=None, retries=0, retry_base=0.5):
+        self.url = url
+        self.auth = None  # Session or API token, added to every call that needs authentication
+        self.reauthenticate = None  # Called with the expired token, set by zabbix_auth
+        self.timeout = timeout
+        self.limiter = limiter or AdaptiveLimiter(pool_size)
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = retries
+        self.retry_base = retry_base
+        self._ids = itertools.count(1)
+        self._ids_lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.headers["Content-Type"] = "application/json-rpc"
+
+    def _payload(self, method, params, auth):
+        with self._ids_lock:
+            request_id = next(self._ids)
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": request_id
+        }
+        if auth and self.auth:
+            payload["auth"] = self.auth
+        return payload
+
+    def _post(self, payload):
+        method = payload["method"] if isinstance(payload, dict) else "batch"
+        calls = payload if isinstance(payload, list) else [payload]
+        if not self.limiter.acquire(len(calls), self.timeout):
+            api_errors.inc(method, "throttled")
+            raise ZabbixConnectionError(f"No free Zabbix API request slot within {self.timeout} seconds")
+        if not self.breaker.allow():
+            self.limiter.release()
+            api_errors.inc(method, "breaker")
+            raise ZabbixUnavailableError(f"Zabbix API is unavailable, circuit breaker open for {self.breaker.retry_in():.0f} more seconds")
+        for call in calls:
+            api_calls.inc(call["method"])
+        # Error replies of the API count as success, Zabbix answered
+        started = time.monotonic()
+        failed = True
+        try:
+            reply = self._send(payload, method)
+            failed = False
+            return reply
+        finally:
+            self.breaker.record(not failed)
+            self.limiter.release(time.monotonic() - started, failed)
+
+    def _send(self, payload, method):
+        try:
+            with api_in_flight.track(), api_latency.time(method):
+                response = self._session.post(self.url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            api_errors.inc(method, "connection")
+            raise ZabbixConnectionError(f"Request to Zabbix failed with error: {e}")
+        if response.status_code != 200:
+            api_errors.inc(method, "connection")
+            raise ZabbixConnectionError(f"Request to Zabbix failed with code: {response.status_code}", code=response.status_code)
+        try:
+            return response.json()
+        except ValueError:
+            api_errors.inc(method, "connection")
+            raise ZabbixConnectionError("Invalid JSON data in Zabbix response")
+
+    @staticmethod
+    def _result(reply, method):
+        if "result" in reply:
+            return reply["result"]
+        api_errors.inc(method, "api")
+        error = reply.get("error", {})
+        raise ZabbixAPIError(error.get("message", "Unknown error"), error.get("code"), error.get("data"), method)
+
+    # Function to run send() again after connection errors when all methods only read data
+    # The delay is random up to a limit that doubles with every retry, so workers do not retry together
+    def _retry_reads(self, methods, send):
+        attempt = 0
+        while True:
+            try:
+                return send()
+            except ZabbixUnavailableError:
+                raise
+            except ZabbixConnectionError as e:
+                # After the failure that opened the circuit breaker there is nothing to retry
+                if attempt >= self.retries or not all(is_read_method(method) for method in methods) or not self.breaker.available():
+                    raise
+                attempt += 1
+                delay = random.uniform(0, self.retry_base * 2 ** (attempt - 1))
+                api_retried.inc(methods[0] if len(methods) == 1 else "batch")
+                logging.warning(f"{e}, retry {attempt} of {self.retries} in {delay:.2f}s")
+                time.sleep(delay)
+
+    # Function to send one API call and return its result
+    # A call rejected because the session expired is sent once more after a new login, unless reauthenticate is False
+    def call(self, method, params, auth=True, reauthenticate=True):
+        payload = self._payload(method, params, auth)
+        try:
+            return self._retry_reads([method], lambda: self._call(payload))
+        except ZabbixAPIError as e:
+            if not auth or not reauthenticate or self.reauthenticate is None or not is_session_error(e):
+                raise
+            self.reauthenticate(payload.get("auth"))
+        payload = self._payload(method, params, auth)
+        return self._retry_reads([method], lambda: self._call(payload))
+
+    def _call(self, payload):
+        reply = self._post(payload)
+        if not isinstance(reply, dict):
+            raise ZabbixConnectionError(f"Unexpected response to {payload['method']}: {reply}")
+        return self._result(reply, payload["method"])
+
+    # Function to send several independent calls in one HTTP request (JSON-RPC batch)
+    # Returns a list in the order of calls, with a result or ZabbixAPIError for every call
+    # Calls rejected because the session expired are sent once more after a new login
+    def batch(self, calls, auth=True):
+        methods = [method for method, _ in calls]
+        results, token = self._retry_reads(methods, lambda: self._batch(calls, auth))
+        expired = [index for index, result in enumerate(results)
+                   if isinstance(result, ZabbixAPIError) and is_session_error(result)]
+        if auth and expired and self.reauthenticate is not None:
+            # Calls that succeeded are not sent again, only the rejected ones
+            self.reauthenticate(token)
+            retried = [calls[index] for index in expired]
+            retried_methods = [method for method, _ in retried]
+            for index, result in zip(expired, self._retry_reads(retried_methods, lambda: self._batch(retried, auth))[0]):
+                results[index] = result
+        return results
+
+    def _batch(self, calls, auth):
+        if not calls:
+            return [], None
+        payloads = [self._payload(method, params, auth) for method, params in calls]
+        replies = self._post(payloads)
+        if not isinstance(replies, list):
+            # The whole batch was rejected, Zabbix replies with one error object
+            error = replies.get("error", {}) if isinstance(replies, dict) else {}
+            raise ZabbixAPIError(error.get("message", "Batch request failed"), error.get("code"), error.get("data"))
+        # Replies are matched by id, because their order is not guaranteed
+        replies_by_id = {reply.get("id"): reply for reply in replies if isinstance(reply, dict)}
+        results = []
+        for payload in payloads:
+            reply = replies_by_id.get(payload["id"])
+            try:
+                if reply is None:
+                    raise ZabbixAPIError("No reply in batch response", method=payload["method"])
+                results.append(self._result(reply, payload["method"]))
+            except ZabbixAPIError as e:
+                results.append(e)
+        return results, payloads[0].get("auth")
+
+
+zabbix_client = ZabbixAPI(zabbix_url, pool_size=pool_size, timeout=request_timeout,
+                          limiter=AdaptiveLimiter(api_max_concurrency, api_min_concurrency, api_max_rate, api_latency_target),
+                          breaker=CircuitBreaker(breaker_failures, breaker_cooldown),
+                          retries=api_retries, retry_base=api_retry_base)
+Gauge("zabbix_suite_api_concurrency_limit", "Concurrent Zabbix API requests allowed by the adaptive limit",
+      function=lambda: int(zabbix_client.limiter.limit))
+Gauge("zabbix_suite_api_breaker_state", "Circuit breaker toward the Zabbix API: 0 closed, 1 half open, 2 open",
+      function=lambda: CircuitBreaker.states.index(zabbix_client.breaker.state()))
@@ -1,56 +1,87 @@
 #!/usr/bin/env python3
 
-import requests
 import logging
 import os
-import json
+import threading
+from zabbix_api import zabbix_client, ZabbixAPIError, ZabbixConnectionError, is_session_error
+from logging_setup import setup_logging
 
 # Set up logging
-logging.basicConfig(filename='logs/zabbix_automation_suite.log', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging()
 
-# Define your Zabbix API endpoint and credentials
-zabbix_url = "https://hetzner-monitor.wee.co.il/zabbix/api_jsonrpc.php"
+# Define your Zabbix credentials
 zabbix_username = str(os.environ.get("ZABBIX_USERNAME")) # !!! Enviromental variable have to be added to a system
 zabbix_password = str(os.environ.get("ZABBIX_PASSWORD")) # !!! Enviromental variable have to be added to a system
+# API token created in Zabbix (Users -> API tokens), used instead of username and password when it is set
+zabbix_api_token = os.environ.get("ZABBIX_API_TOKEN")
 
-def zabbix_authentication():   
-   # User authentication payload
-    authentication = {
-        "jsonrpc": "2.0",
-        "method": "user.login",
-        "params": {
-            "user": zabbix_username,
-            "password": zabbix_password
-        },
-        "id": 2
-    }    
-    # User logout payload
-    logout = {
-        "jsonrpc": "2.0",
-        "method": "user.logout",
-        "params": [],
-        "id": 1
-    }    
-    kill_sessions = requests.post(zabbix_url, json=logout)
-    logging.info(f"Logout from Zabbix request executed with status code: {kill_sessions.status_code}")
-    with open("auth/zabbix_auth.txt", "w") as f:
-        f.write("")
-        os.chmod("auth/zabbix_auth.txt", 0o600)
-    # Post authentication and save hash value to a variable
-    try:
-        auth = requests.post(zabbix_url, json=authentication)
-        auth.raise_for_status()  # Raise HTTPError for bad responses        
-        auth_parsed = auth.json()
-        if "result" in auth_parsed:
-            logging.info("Authentificated to Zabbix successfuly")
-            with open("auth/zabbix_auth.txt", "w") as f:
-                f.write(auth_parsed['result'])
-                return True
-        else: 
-#            logging.info(f"{zabbix_username}, {zabbix_password}")
-            logging.critical(f"Authentication failed with error: {json.dumps(auth_parsed['error'], indent=4)}")
-            return False            
-    except requests.RequestException as exception:
-        logging.critical(f"Connection to Zabbix failed with exception: {exception}")
-        return False
+
+# Class with the token of the shared Zabbix API client, logs in again when the session expires
+class ZabbixTokenManager:
+    def __init__(self, client, username, password, api_token=None):
+        self._client = client
+        self._username = username
+        self._password = password
+        self._api_token = api_token
+        self._lock = threading.RLock()  # The API token check can call reauthenticate() again
+        self.logins = 0  # Successful logins since the start, the first one included
+
+    # Function to log in with username and password, or to check the API token
+    def login(self):
+        with self._lock:
+            return self._login()
+
+    def _login(self):
+        try:
+            if self._api_token:
+                # An API token does not expire with the session, a cheap call checks it is valid
+                self._client.auth = self._api_token
+                self._client.call("hostgroup.get", {"output": ["groupid"], "limit": 1})
+                logging.info("Authentificated to Zabbix with API token")
+            else:
+                self._client.auth = self._client.call("user.login", {"user": self._username, "password": self._password}, auth=False)
+                logging.info("Authentificated to Zabbix successfuly")
+        except ZabbixConnectionError as exception:
+            logging.critical(f"Connection to Zabbix failed with exception: {exception}")
+            return False
+        except ZabbixAPIError as exception:
+            logging.critical(f"Authentication failed with error: {exception}")
+            return False
+        self.logins += 1
+        return True
+
+    # Function called by the API client when a call was rejected with the expired token
+    # Only the first worker with this token logs in, the others wait and then use the new token
+    def reauthenticate(self, expired_token):
+        with self._lock:
+            if self._client.auth != expired_token:
+                return
+            if self._api_token:
+                logging.critical("Zabbix API token was rejected, create a new one and update ZABBIX_API_TOKEN")
+                return
+            logging.warning("Zabbix session expired, logging in again")
+            self._login()
+
+    # Function to end the session on shutdown, API tokens are left valid
+    # An expired session is already logged out, so there is no new login for the logout
+    def logout(self):
+        with self._lock:
+            if self._api_token or not self._client.auth:
+                return
+            try:
+                self._client.call("user.logout", [], reauthenticate=False)
+                logging.info("Logout from Zabbix request executed")
+            except ZabbixAPIError as e:
+                if is_session_error(e):
+                    logging.info("Zabbix session had already expired, no logout needed")
+                else:
+                    logging.info(f"Logout from Zabbix request executed with result: {e}")
+            self._client.auth = None
+
+
+token_manager = ZabbixTokenManager(zabbix_client, zabbix_username, zabbix_password, zabbix_api_token)
+zabbix_client.reauthenticate = token_manager.reauthenticate
+
+
+def zabbix_authentication():
+    return token_manager.login()
@@ -1,222 +1,507 @@
 #!/usr/bin/env python3
 
 import time
-import socket
 import json
-import requests
 import logging
-import sys
 import os
-import re
 import subprocess
-import time
-from zabbix_auth import zabbix_authentication
-
-templates_with_id = []
-groups_with_id = []
-auth_key = ""
-
-# Set up logging for script
-logging.basicConfig(filename='logs/zabbix_automation_suite.log', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
-
-zabbix_url = "https://hetzner-monitor.wee.co.il/zabbix/api_jsonrpc.php"
-
-# Function to obtain templates' IDs with specific names
-def get_templates_id():
-    templates = ["Template OS Windows", "Template OS Linux", "template cPanel backup"]
-    global templates_with_id
-    # Payload for search template ID with template name
-    templateget = {
-        "jsonrpc": "2.0",
-        "method": "template.get",
-        "params": {
-            "output": ["templateid", "name"],
-            "filter": {
-                "host": templates
-            }
-        },
-        "id": 3,
-        "auth": auth_key
-    }
-    templates_info = requests.post(zabbix_url, json=templateget)
-    if templates_info.status_code == 200:
-        templates_info_pars = templates_info.json()
-        if "result" in templates_info_pars:
-            templates_with_id = templates_info_pars["result"]
-            logging.info(f"Templates with IDs retrieved successfully")
-            # logging.info(templates_with_id)
-        else: 
-            logging.warning(f"Request for templates with IDs failed with error: {json.dumps(templates_info_pars['error'], indent=4)}")
-    else:
-        logging.warning(f"Request for templates IDs failed with code: {templates_info.status_code}")
-
-# Function to obtain groups' IDs with scecific names       
-def get_groups_id():
-    groups = ["Allwindows", "Windows General", "Linux servers", "Fortigate", "Uniq", "cPanels", "Clients"]
-    global groups_with_id
-    # Payload for search group ID with group name
-    hostgroupget = {
-        "jsonrpc": "2.0",
-        "method": "hostgroup.get",
-        "params": {
-            "output": ["groupid", "name"],
-            "filter": {
-                "name": groups
-            }
-        },
-        "id": 4,
-        "auth": auth_key
-    }
-    groups_info = requests.post(zabbix_url, json=hostgroupget)
-    if groups_info.status_code == 200:
-        groups_info_pars = groups_info.json()
-        if "result" in groups_info_pars:
-            groups_with_id = groups_info_pars["result"]
-            logging.info(f"Groups with IDs retrieved successfully")
-            # logging.info(groups_with_id)
+import signal
+import threading
+import sqlite3
+import urllib.parse
+from zabbix_auth import zabbix_authentication, token_manager
+from zabbix_api import zabbix_client, ZabbixAPIError, ZabbixConnectionError
+from worker_pool import Batcher, KeyedLocks, WorkerPool
+from host_index import HostIndex
+from fingerprint_cache import FingerprintCache, fingerprint
+from http_server import HTTPServer
+from id_registry import IdRegistry
+from proxy_registry import ProxyRegistry
+from psk_store import PskStore
+from work_queue import WorkQueue
+from classification import ClassificationRules, RuleError
+from metrics import registry as metrics_registry, Counter, Gauge, Histogram
+from cache_snapshot import save_snapshot, load_snapshot
+from sd_notify import notify
+from logging_setup import setup_logging, correlation, correlation_id, new_correlation_id, DumpSampler
+
+# Set up logging for script, records are written to the file by a background thread
+setup_logging()
+# Big dumps of host data are only written with ZABBIX_SUITE_LOG_LEVEL=DEBUG, a few per minute
+debug_dumps = DumpSampler()
+
+# Concurrency settings, can be overridden with environmental variables
+max_workers = int(os.environ.get("ZABBIX_SUITE_WORKERS", 16))  # Webhooks processed at the same time
+max_pending = int(os.environ.get("ZABBIX_SUITE_MAX_PENDING", 256))  # Connections waiting for a free connection worker
+connection_workers = int(os.environ.get("ZABBIX_SUITE_CONNECTION_WORKERS", 8))  # Connections read and acknowledged at the same time
+coalesce_window = float(os.environ.get("ZABBIX_SUITE_COALESCE_WINDOW", 5))  # Seconds to collect webhooks of one VM before processing
+listen_backlog = int(os.environ.get("ZABBIX_SUITE_BACKLOG", 128))
+client_timeout = int(os.environ.get("ZABBIX_SUITE_CLIENT_TIMEOUT", 30))  # Seconds to wait for the rest of a started request
+keepalive_timeout = int(os.environ.get("ZABBIX_SUITE_KEEPALIVE_TIMEOUT", 75))  # Seconds an idle connection is kept open
+max_body_size = int(os.environ.get("ZABBIX_SUITE_MAX_BODY_SIZE", 1048576))  # Bigger requests are answered with 413
+drain_timeout = int(os.environ.get("ZABBIX_SUITE_DRAIN_TIMEOUT", 60))  # Seconds to finish in-flight webhooks on shutdown
+
+# Work queue settings, webhooks are kept on disk until they are processed
+queue_path = os.environ.get("ZABBIX_SUITE_QUEUE_PATH", "queue/zabbix_suite_queue.db")
+max_attempts = int(os.environ.get("ZABBIX_SUITE_MAX_ATTEMPTS", 8))  # Failed attempts before a webhook is moved to dead_letter
+retry_base = float(os.environ.get("ZABBIX_SUITE_RETRY_BASE", 5))  # Seconds before the first retry, doubled with every attempt
+retry_max = float(os.environ.get("ZABBIX_SUITE_RETRY_MAX", 600))  # Maximum seconds between retries
+
+# Host creation settings: "api" calls host.create directly, "ansible" runs zabbix_create_host.yml
+create_backend = os.environ.get("ZABBIX_SUITE_CREATE_BACKEND", "api").lower()
+create_batch_size = int(os.environ.get("ZABBIX_SUITE_CREATE_BATCH_SIZE", 50))  # Hosts per host.create request
+create_batch_window = float(os.environ.get("ZABBIX_SUITE_CREATE_BATCH_WINDOW", 0.2))  # Seconds to wait for more hosts
+# The playbook connects to the Zabbix API of ZABBIX_URL, the session token of this process is only sent there
+zabbix_api_url = urllib.parse.urlsplit(zabbix_client.url)
+ansible_api_environment = {
+    "ZABBIX_API_HOST": zabbix_api_url.hostname or "",
+    "ZABBIX_API_PORT": str(zabbix_api_url.port or (443 if zabbix_api_url.scheme == "https" else 80)),
+    "ZABBIX_API_USE_SSL": str(zabbix_api_url.scheme == "https"),
+    "ZABBIX_API_URL_PATH": zabbix_api_url.path.rsplit("/", 1)[0].strip("/")  # "zabbix" for /zabbix/api_jsonrpc.php
+}
+
+# Host update settings, concurrent updates are sent together so hosts with the same change share API calls
+update_batch_size = int(os.environ.get("ZABBIX_SUITE_UPDATE_BATCH_SIZE", 50))  # Hosts per batch request
+update_batch_window = float(os.environ.get("ZABBIX_SUITE_UPDATE_BATCH_WINDOW", 0.2))  # Seconds to wait for more hosts
+
+# Lookup caches (template, group and proxy IDs, host index) are saved to a snapshot file and loaded at start
+# With a snapshot the service is ready after the login, the caches are checked against Zabbix in the background
+snapshot_path = os.environ.get("ZABBIX_SUITE_SNAPSHOT_PATH", "cache/zabbix_suite_snapshot.json")  # Empty to disable
+snapshot_interval = int(os.environ.get("ZABBIX_SUITE_SNAPSHOT_INTERVAL", 300))  # Seconds between snapshots
+snapshot_max_age = int(os.environ.get("ZABBIX_SUITE_SNAPSHOT_MAX_AGE", 86400))  # Older snapshots are not loaded
+
+# Host index settings
+host_index_size = int(os.environ.get("ZABBIX_SUITE_HOST_INDEX_SIZE", 100000))  # Maximum number of indexed IP addresses
+host_index_refresh = int(os.environ.get("ZABBIX_SUITE_HOST_INDEX_REFRESH", 300))  # Seconds between checks for new and deleted hosts
+host_index_full_refresh = int(os.environ.get("ZABBIX_SUITE_HOST_INDEX_FULL_REFRESH", 3600))  # Seconds between full reloads
+
+# Metrics served on /metrics in the Prometheus text format
+stage_latency = Histogram("zabbix_suite_stage_seconds", "Duration of webhook processing stages", ["stage"])
+webhook_outcomes = Counter("zabbix_suite_webhooks_total", "Processed webhooks by outcome", ["outcome"])
+rejected_webhooks = Counter("zabbix_suite_webhooks_rejected_total", "Webhooks of VMs that are not monitored, by reason", ["reason"])
+http_requests = Counter("zabbix_suite_http_requests_total", "HTTP requests answered by the listener", ["method", "status"])
+http_in_flight = Gauge("zabbix_suite_http_requests_in_flight", "HTTP requests being answered")
+update_calls = Counter("zabbix_suite_host_update_calls_total", "API calls sent to update hosts, by method", ["method"])
+update_calls_replaced = Counter("zabbix_suite_host_update_calls_replaced_total", "host.update calls the same updates needed with one full update per host")
+webhooks_in_progress = Gauge("zabbix_suite_webhooks_in_progress", "Webhooks being processed by workers")
+
+# Rules for templates, groups and proxy of NetBox VMs, compiled once and replaced on SIGHUP
+rules_path = os.environ.get("ZABBIX_SUITE_RULES", "classification_rules.json")
+classification_rules = ClassificationRules.from_file(rules_path)
+
+# Zabbix hosts by IP address, so most webhooks are handled without a host.get request
+host_index = HostIndex(zabbix_client, max_hosts=host_index_size)
+Gauge("zabbix_suite_host_index_size", "IP addresses in the host index", function=lambda: len(host_index))
+
+# Fingerprints of the last state written to Zabbix by VM ID, webhooks that change nothing for Zabbix end here
+fingerprint_cache_size = int(os.environ.get("ZABBIX_SUITE_FINGERPRINT_CACHE_SIZE", 100000))  # Maximum number of VMs
+fingerprint_cache_ttl = int(os.environ.get("ZABBIX_SUITE_FINGERPRINT_CACHE_TTL", 86400))  # Seconds a fingerprint is trusted
+fingerprint_cache_path = os.environ.get("ZABBIX_SUITE_FINGERPRINT_CACHE_PATH", "")  # SQLite file, empty to keep them in memory only
+fingerprint_cache = None  # Opened by main(), only the service uses the cache
+fingerprint_lookups = Counter("zabbix_suite_fingerprint_cache_total", "Fingerprint cache lookups by result", ["result"])
+Gauge("zabbix_suite_fingerprint_cache_size", "VMs in the fingerprint cache", function=lambda: len(fingerprint_cache))
+
+# Template and group name -> ID registries, proxies with their load for the proxy groups of the rules
+id_cache_ttl = int(os.environ.get("ZABBIX_SUITE_ID_CACHE_TTL", 3600))  # Seconds before an ID is searched again
+create_missing_groups = os.environ.get("ZABBIX_SUITE_CREATE_MISSING_GROUPS", "false").lower() in ("1", "true", "yes")
+template_registry = IdRegistry(zabbix_client, "template", "templateid", filter_field="host", ttl=id_cache_ttl)
+group_registry = IdRegistry(zabbix_client, "hostgroup", "groupid", create_missing=create_missing_groups, ttl=id_cache_ttl)
+proxy_refresh = int(os.environ.get("ZABBIX_SUITE_PROXY_REFRESH", 300))  # Seconds between reads of the hosts per proxy
+proxy_registry = ProxyRegistry(zabbix_client)
+proxy_registry.set_groups(classification_rules.proxy_groups())
+Gauge("zabbix_suite_proxy_hosts", "Hosts monitored by every proxy of the proxy groups", ["group", "proxy"],
+      function=lambda: {(group, name): hosts for group, proxies in proxy_registry.load().items() for name, hosts in proxies.items()})
+Gauge("zabbix_suite_proxy_capacity", "Capacity of every proxy of the proxy groups from the rules", ["group", "proxy"],
+      function=lambda: {(group, name): capacity for group, proxies in proxy_registry.capacity().items() for name, capacity in proxies.items()})
+
+# PSK of every host created by the suite, the keys are generated here and never leave the process in a command line
+psk_store = None  # Opened by main() and by zabbix_reconcile.py
+
+# Webhooks for the same IP address or VM are processed one at a time
+host_locks = KeyedLocks()
+shutdown_requested = threading.Event()
+
+# Set when the service is logged in to Zabbix and the lookup caches are loaded, webhooks are only processed after that
+service_ready = threading.Event()
+warm_up_state = {"authenticated": False, "caches": "empty", "revalidated": False, "started": time.time(), "ready_seconds": None}
+Gauge("zabbix_suite_ready", "1 when webhooks are processed, 0 during the warm-up", function=lambda: int(service_ready.is_set()))
+
+# Requests are only read and acknowledged, webhooks are processed by a separate pool
+connection_pool = WorkerPool(connection_workers, max_pending)
+processing_pool = WorkerPool(max_workers, max_pending)
+# Workers without a webhook, the dispatcher only claims queued webhooks for free workers
+free_workers = threading.Semaphore(max_workers)
+
+# Function to load or refresh IDs of templates, groups and proxies with one batch request, returns False on errors
+def get_templates_groups_proxies_id():
+    # Names used by the rules in classify_netbox_vm() are loaded before the first webhook
+    templates = classification_rules.template_names()
+    groups = classification_rules.group_names()
+    registries = [
+        (template_registry, dict.fromkeys(templates + template_registry.names())),
+        (group_registry, dict.fromkeys(groups + group_registry.names())),
+        (proxy_registry, None)  # All proxies with their hosts
+    ]
+    try:
+        results = zabbix_client.batch([registry.lookup_call(names) for registry, names in registries])
+    except ZabbixAPIError as e:
+        logging.warning(f"Request for templates, groups and proxies IDs failed with error: {e}")
+        return False
+    loaded = True
+    for (registry, names), result in zip(registries, results):
+        if isinstance(result, ZabbixAPIError):
+            logging.warning(f"Request for {registry.kind} IDs failed with error: {result}")
+            loaded = False
         else:
-            logging.warning(f"Request for groups with IDs failed with error: {json.dumps(groups_info_pars['error'], indent=4)}")
-    else:
-        logging.warning(f"Request for templates IDs failed with code: {groups_info.status_code}")
+            registry.store(result, names or ())
+            logging.info(f"IDs of {len(registry)} {registry.kind} names retrieved successfully")
+    return loaded
 
+# Function to refresh template, group and proxy IDs in the background before they expire
+def start_id_refresh(interval):
+    def refresh_loop():
+        while not shutdown_requested.wait(interval):
+            get_templates_groups_proxies_id()
+    threading.Thread(target=refresh_loop, name="id-refresh", daemon=True).start()
 
 # Function to check if IP address exists in Zabbix
-def check_ip_in_zabbix(ip_address, client_socket):
-    # Payload for host search in Zabbix with IP
+def check_ip_in_zabbix(ip_address):
+    # Parameters for host search in Zabbix with IP
     hostget = {
-        "jsonrpc": "2.0",
-        "method": "host.get",
-        "params": {
-            "output": ["hostid", "host", "name"],
-            "selectParentTemplates": ["templateid", "name"],
-            "selectGroups": ["groupid", "name"],
-            "filter": {"ip": ip_address}
-        },
-        "id": 5,
-        "auth": auth_key
+        "output": ["hostid", "host", "name"],
+        "selectParentTemplates": ["templateid", "name"],
+        "selectGroups": ["groupid", "name"],
+        "filter": {"ip": ip_address}
     }
     # Send the API request
     try:
-        hostinfo = requests.post(zabbix_url, json=hostget)
-    except Exception as e:
-        logging.error(f"Host.get request to Zabbix failed with error: {e}")
-        response = ("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 48\r\n\r\nConnection received but connect to Zabbix failed")
-        client_socket.sendall(response.encode())
+        hostinfo = zabbix_client.call("host.get", hostget)
+    except ZabbixConnectionError as e:
+        logging.error("Host.get request to Zabbix failed with error: %s", e)
         return
-    # Parse the response and check if the IP address exists
-    try:
-        hostinfo_pars = hostinfo.json()
-    except json.JSONDecodeError:
-        logging.error("Invalid JSON data")
-        client_socket.close()
+    except ZabbixAPIError as e:
+        logging.warning("Host IP %s search failed with error: %s", ip_address, e)
         return
-            
-    if "result" in hostinfo_pars and len(hostinfo_pars["result"]) != 0:
+
+    if len(hostinfo) != 0:
         # Save host info from Zabbix to a variable
         try:
             zabbix_host = { 
-                "hostid": hostinfo_pars["result"][0]["hostid"],
-                "hostname": hostinfo_pars["result"][0]["host"],
-                "visiblename": hostinfo_pars["result"][0]["name"],
+                "hostid": hostinfo[0]["hostid"],
+                "hostname": hostinfo[0]["host"],
+                "visiblename": hostinfo[0]["name"],
                 "ip": ip_address,
-                "groups": hostinfo_pars["result"][0]["groups"],
-                "templates": hostinfo_pars["result"][0]["parentTemplates"]
+                "groups": hostinfo[0]["groups"],
+                "templates": hostinfo[0]["parentTemplates"]
                 }
-            logging.info(f"Host IP {ip_address} already exists in Zabbix")
+            logging.info("Host IP %s already exists in Zabbix", ip_address)
+            host_index.put(zabbix_host)
             return zabbix_host  # IP address exists in Zabbix
         except Exception as e:
-            logging.error(f"Error in check_ip_in_zabbix() function in zabbix_host dictionary {e}")
+            logging.error("Error in check_ip_in_zabbix() function in zabbix_host dictionary %s", e)
             return
-    elif len(hostinfo_pars["result"]) == 0:
-        logging.info(f"Host IP {ip_address} was not found")
-        response = ("HTTP/1.1 404 Not Found\r\nContent-Length: 50\r\n\r\nConnection received but IP was not found in Zabbix")
-        client_socket.sendall(response.encode())
+    else:
+        logging.info("Host IP %s was not found", ip_address)
+        host_index.invalidate(ip_address)
         return False
-    else: 
-        logging.warning(f"Host IP {ip_address} search failed with error: {json.dumps(hostinfo_pars['error'], indent=4)}")
-        response = ("HTTP/1.1 502 Bad Gateway\r\nContent-Length: 49\r\n\r\nConnection received but IP search in Zabbix failed")
-        client_socket.sendall(response.encode())
-        return
 
 # Function to check accuracy between Zabbix and NetBox
+# Returns (changes, zabbix_host, fields_change, templates_change, groups_change), zabbix_host is changed to the NetBox data
+# fields_change has the changed host.update fields, templates_change and groups_change the names to add and the objects to remove
 def check_zabbix_accuracy(zabbix_host, netbox_host):
-    changes = False
-    templates_change = False
-    groups_change = False
+    fields_change = {}
+    templates_change = None
+    groups_change = None
     # Compare and update simple fields
-    for key in ["hostname", "visiblename"]:
+    for key, field in [("hostname", "host"), ("visiblename", "name")]:
         if zabbix_host[key] != netbox_host[key]:
-            logging.info(f"Updating {key}: \"{zabbix_host[key]}\" -> \"{netbox_host[key]}\"")
+            logging.info('Updating %s: "%s" -> "%s"', key, zabbix_host[key], netbox_host[key])
             zabbix_host[key] = netbox_host[key]
-            changes = True
-    # Append unique templates
+            fields_change[field] = netbox_host[key]
+    # Only the templates that differ are linked or unlinked, the others stay as they are
     zabbix_host_templates = [template["name"] for template in zabbix_host["templates"]] 
     if set(netbox_host["templates"]) != set(zabbix_host_templates) and "template cPanel backup" not in zabbix_host_templates:
-        logging.info(f"Templates differ between NetBox and Zabbix. Replacing Zabbix templates with NetBox ones.")
-        zabbix_host["templates"] = [{"name": template} for template in netbox_host["templates"]]
-        changes = True
-        templates_change = True
-    # Append unique groups
+        templates_change = list_change(zabbix_host["templates"], netbox_host["templates"])
+        logging.info("Templates differ between NetBox and Zabbix, adding %s and removing %s",
+                     templates_change["add"], [template["name"] for template in templates_change["remove"]])
+    # Only the groups that differ are added or removed
     zabbix_host_groups = [group["name"] for group in zabbix_host["groups"]]
     if set(netbox_host["groups"]) != set(zabbix_host_groups):
-        logging.info(f"Groups differ between NetBox and Zabbix. Replacing Zabbix groups with NetBox ones.")
-        zabbix_host["groups"] = [{"name": group} for group in netbox_host["groups"]]
-        changes = True
-        groups_change = True
-    return changes, zabbix_host, templates_change, groups_change
-
-# Function to update a host in Zabbix
-def zabbix_update_host(zabbix_host, templates_change, groups_change):        
-    if templates_change:
-        # Iterate over each template in zabbix_host["templates"] and complete missing template IDs
-        for template in zabbix_host["templates"]:
-            if "templateid" not in template:
-                for template_with_id in templates_with_id:
-                    if template_with_id["name"] == template["name"]:
-                        template["templateid"] = template_with_id["templateid"]
-                        break  # Exit the inner loop once the templateid is found
-    if groups_change:
-        # Iterate over each group in zabbix_host["groups"] and complete missing group IDs
-        for group in zabbix_host["groups"]:
-            if "groupid" not in group:
-                for group_with_id in groups_with_id:
-                    if group_with_id["name"] == group["name"]:
-                        group["groupid"] = group_with_id["groupid"]
-                        break  # Exit the inner loop once the group is found
-    # Payload for host update in Zabbix
-    host_update = {
-        "jsonrpc": "2.0",
-        "method": "host.update",
-        "params": {
-            "hostid": zabbix_host["hostid"],
-            "host": zabbix_host["hostname"],
-            "name": zabbix_host["visiblename"],
-            "templates": [template["templateid"] for template in zabbix_host["templates"]],
-            "groups": [group["groupid"] for group in zabbix_host["groups"]]
-        },
-        "id": 6,
-        "auth": auth_key
-    }
-    # Send update request to Zabbix and check the result
+        groups_change = list_change(zabbix_host["groups"], netbox_host["groups"])
+        logging.info("Groups differ between NetBox and Zabbix, adding %s and removing %s",
+                     groups_change["add"], [group["name"] for group in groups_change["remove"]])
+    changes = bool(fields_change or templates_change or groups_change)
+    return changes, zabbix_host, fields_change or None, templates_change, groups_change
+
+# Function to replace the templates or groups of a Zabbix host with NetBox names in place, returns what was added and removed
+# Kept objects keep their IDs, added ones only have a name until build_host_update_calls() resolves it
+def list_change(zabbix_objects, netbox_names):
+    netbox_names = list(dict.fromkeys(netbox_names))
+    kept = [zabbix_object for zabbix_object in zabbix_objects if zabbix_object["name"] in netbox_names]
+    removed = [zabbix_object for zabbix_object in zabbix_objects if zabbix_object["name"] not in netbox_names]
+    kept_names = {zabbix_object["name"] for zabbix_object in kept}
+    added = [name for name in netbox_names if name not in kept_names]
+    zabbix_objects[:] = kept + [{"name": name} for name in added]
+    return {"add": added, "remove": removed}
+
+# Function to resolve the IDs of added templates and groups of one host, raises KeyError for names without an ID
+def resolve_host_change(zabbix_host, templates_change, groups_change):
+    for change, objects, registry, id_field in [(templates_change, zabbix_host["templates"], template_registry, "templateid"),
+                                                (groups_change, zabbix_host["groups"], group_registry, "groupid")]:
+        if not change:
+            continue
+        ids = registry.resolve(change["add"])
+        for zabbix_object in objects:
+            if id_field not in zabbix_object and zabbix_object["name"] in ids:
+                zabbix_object[id_field] = ids[zabbix_object["name"]]
+    missing = [template["name"] for template in zabbix_host["templates"] if "templateid" not in template]
+    missing += [group["name"] for group in zabbix_host["groups"] if "groupid" not in group]
+    if missing:
+        raise KeyError(f"IDs not found for: {', '.join(missing)}")
+
+# Function to build the fewest API calls for host changes by position, returns (method, params, positions) tuples
+# Hosts changed to the same templates and groups share one host.massupdate, other hosts get host.massadd and
+# host.massremove calls with only the added and removed IDs, shared by hosts with the same additions or removals
+def build_host_update_calls(updates):
+    calls = []
+    # Names and visible names are different for every host, they are sent with host.update
+    for position, (zabbix_host, fields_change, _, _) in updates.items():
+        if fields_change:
+            calls.append(("host.update", dict(fields_change, hostid=zabbix_host["hostid"]), [position]))
+
+    # Hosts with the same target templates and groups, only the changed lists are part of the key
+    targets = {}
+    for position, (zabbix_host, _, templates_change, groups_change) in updates.items():
+        if templates_change or groups_change:
+            key = (frozenset(template["templateid"] for template in zabbix_host["templates"]) if templates_change else None,
+                   frozenset(group["groupid"] for group in zabbix_host["groups"]) if groups_change else None)
+            targets.setdefault(key, []).append(position)
+    single = set()
+    for (template_ids, group_ids), positions in targets.items():
+        if len(positions) < 2:
+            single.update(positions)
+            continue
+        params = {"hosts": [{"hostid": updates[position][0]["hostid"]} for position in positions]}
+        if template_ids is not None:
+            params["templates"] = [{"templateid": templateid} for templateid in sorted(template_ids)]
+        if group_ids is not None:
+            params["groups"] = [{"groupid": groupid} for groupid in sorted(group_ids)]
+        calls.append(("host.massupdate", params, positions))
+
+    # Additions are sent before removals, so a host never has no groups between the two calls
+    additions = {}
+    removals = {}
+    for position, (zabbix_host, _, templates_change, groups_change) in updates.items():
+        if position not in single:
+            continue
+        added_templates = frozenset(template["templateid"] for template in zabbix_host["templates"]
+                                    if templates_change and template["name"] in templates_change["add"])
+        added_groups = frozenset(group["groupid"] for group in zabbix_host["groups"]
+                                 if groups_change and group["name"] in groups_change["add"])
+        removed_templates = frozenset(template["templateid"] for template in templates_change["remove"]) if templates_change else frozenset()
+        removed_groups = frozenset(group["groupid"] for group in groups_change["remove"]) if groups_change else frozenset()
+        if added_templates or added_groups:
+            additions.setdefault((added_templates, added_groups), []).append(position)
+        if removed_templates or removed_groups:
+            removals.setdefault((removed_templates, removed_groups), []).append(position)
+    for (template_ids, group_ids), positions in additions.items():
+        params = {"hosts": [{"hostid": updates[position][0]["hostid"]} for position in positions]}
+        if template_ids:
+            params["templates"] = [{"templateid": templateid} for templateid in sorted(template_ids)]
+        if group_ids:
+            params["groups"] = [{"groupid": groupid} for groupid in sorted(group_ids)]
+        calls.append(("host.massadd", params, positions))
+    for (template_ids, group_ids), positions in removals.items():
+        params = {"hostids": [updates[position][0]["hostid"] for position in positions]}
+        if template_ids:
+            params["templateids"] = sorted(template_ids)
+        if group_ids:
+            params["groupids"] = sorted(group_ids)
+        calls.append(("host.massremove", params, positions))
+    return calls
+
+# Function to update many hosts with one batch request, takes (zabbix_host, fields_change, templates_change, groups_change) tuples
+# Returns True or False for every host
+def zabbix_update_hosts(updates):
+    updated = [False] * len(updates)
+    resolved = {}
+    for position, (zabbix_host, fields_change, templates_change, groups_change) in enumerate(updates):
+        try:
+            resolve_host_change(zabbix_host, templates_change, groups_change)
+            resolved[position] = updates[position]
+        except KeyError as e:
+            logging.error("Host %s with IP %s update skipped: %s", zabbix_host['visiblename'], zabbix_host['ip'], e)
+    calls = build_host_update_calls(resolved)
+    if not calls:
+        for position in resolved:
+            updated[position] = True
+        return updated
     try:
-        update_request = requests.post(zabbix_url, json=host_update)
-    except Exception as e:
-        logging.error(f"Host.update request to Zabbix failed with error: {e}")
-        response = ("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 48\r\n\r\nConnection received but connect to Zabbix failed")
-        client_socket.sendall(response.encode())
-
-    if update_request.status_code == 200:
-        update_request_pars = update_request.json()
-        if "result" in update_request_pars:
-            logging.info(f"Host {zabbix_host['visiblename']} with IP {zabbix_host['ip']} updated succesfully")
+        results = zabbix_client.batch([(method, params) for method, params, _ in calls])
+    except ZabbixAPIError as e:
+        logging.error("Batch update of %s hosts failed with error: %s", len(resolved), e)
+        for position in resolved:
+            host_index.invalidate(updates[position][0]["ip"])
+        return updated
+    # A host is updated when all calls with its ID succeeded
+    failed = {}
+    renamed = {}
+    for (method, params, positions), result in zip(calls, results):
+        update_calls.inc(method)
+        if isinstance(result, ZabbixAPIError):
+            for position in positions:
+                failed.setdefault(position, f"{method}: {result}")
+    for position in resolved:
+        zabbix_host = updates[position][0]
+        if position in failed:
+            logging.error("Host %s with IP %s update failed with error: %s", zabbix_host['visiblename'], zabbix_host['ip'], failed[position])
+            host_index.invalidate(zabbix_host["ip"])
         else:
-            logging.error(f"Host {zabbix_host['visiblename']} with IP {zabbix_host['ip']} update failed with error: {json.dumps(update_request_pars['error'], indent=4)}")
-    else: 
-        logging.error(f"Connect to Zabbix failed with code: {update_request.status_code}")
+            updated[position] = True
+            logging.info("Host %s with IP %s updated succesfully", zabbix_host['visiblename'], zabbix_host['ip'])
+            host_index.put(zabbix_host)
+            if updates[position][1] and "host" in updates[position][1]:
+                renamed[zabbix_host["hostid"]] = zabbix_host["hostname"]
+    if renamed:
+        rename_psks(renamed)
+    # Before minimal updates every host was sent with its own host.update call
+    update_calls_replaced.inc(amount=len(resolved))
+    logging.info("%s hosts updated with %s API calls instead of %s host.update calls", len(resolved), len(calls), len(resolved))
+    return updated
+
+# Host updates from concurrent workers are collected, so hosts with the same change share API calls
+update_batcher = Batcher(zabbix_update_hosts, update_batch_size, update_batch_window)
+
+# Function to update a host in Zabbix, concurrent updates are sent as one batch
+def zabbix_update_host(zabbix_host, fields_change, templates_change, groups_change):
+    return update_batcher.submit((zabbix_host, fields_change, templates_change, groups_change))
 
-# Function to create a host in Zabbix
-def zabbix_create_host(host_name, visible_name, proxy, ip_address, templates, groups):
+# Function to build host.create parameters with template and group IDs from the registries
+# The host gets the least loaded proxy of its proxy group, the PSK is added by zabbix_create_hosts()
+def build_host_create_params(host_name, visible_name, proxy_group, ip_address, templates, groups):
+    template_ids = template_registry.resolve(templates)
+    group_ids = group_registry.resolve(groups)
+    # dict.fromkeys() drops duplicates and keeps the order
+    missing = [name for name in dict.fromkeys(templates) if name not in template_ids]
+    missing += [name for name in dict.fromkeys(groups) if name not in group_ids]
+    if missing:
+        raise KeyError(f"IDs not found for: {', '.join(missing)}")
+    proxyid = proxy_registry.select(proxy_group)[0] if proxy_group else "0"
+    return {
+        "host": host_name,
+        "name": visible_name,
+        "interfaces": [{
+            "type": 1,
+            "main": 1,
+            "useip": 1,
+            "ip": ip_address,
+            "dns": "",
+            "port": "10050"
+        }],
+        "proxy_hostid": proxyid,
+        "groups": [{"groupid": group_ids[name]} for name in dict.fromkeys(groups)],
+        "templates": [{"templateid": template_ids[name]} for name in dict.fromkeys(templates)],
+        "status": 0,
+        "tls_connect": 2,
+        "tls_accept": 2
+    }
+
+# Function to create many hosts with a single host.create request, returns a host ID (or None) for every host
+def zabbix_create_hosts(hosts):
+    hostids = [None] * len(hosts)
+    params = []
+    positions = []
+    for position, host in enumerate(hosts):
+        try:
+            params.append(build_host_create_params(**host))
+            positions.append(position)
+        except KeyError as e:
+            logging.error("Host [%s] creation skipped: %s", host['visible_name'], e)
+    if not params:
+        return hostids
+    # New keys are in the store before they are sent, a host is never created with a key that could be lost
+    try:
+        keys = psk_store.stage([host_params["host"] for host_params in params])
+    except sqlite3.Error as e:
+        logging.error("PSKs of %s hosts could not be stored, creation skipped: %s", len(params), e)
+        release_proxies(params)
+        return hostids
+    for host_params in params:
+        host_params["tls_psk_identity"], host_params["tls_psk"] = keys[host_params["host"]]
+    # host.create accepts an array of hosts
+    try:
+        create_result = zabbix_client.call("host.create", params)
+    except ZabbixConnectionError as e:
+        logging.error("Host.create request to Zabbix failed with error: %s", e)
+        release_proxies(params)
+        return hostids
+    except ZabbixAPIError as e:
+        release_proxies(params)
+        # Zabbix rejects the whole array if one host is invalid, so retry one by one to create the others
+        if len(params) > 1:
+            logging.warning("Batch host.create of %s hosts failed, retrying hosts one by one", len(params))
+            for position in positions:
+                hostids[position] = zabbix_create_hosts([hosts[position]])[0]
+            return hostids
+        logging.error("Host [%s] creation failed with error: %s", hosts[positions[0]]['visible_name'], e)
+        return hostids
+    for position, host_params, hostid in zip(positions, params, create_result["hostids"]):
+        hostids[position] = hostid
+        proxy_registry.commit(host_params["proxy_hostid"])
+        logging.info("Host [%s] created successfully with ID %s", hosts[position]['visible_name'], hostid)
+    host_index.load_hosts(create_result["hostids"])
+    confirm_psks({params[index]["host"]: hostid for index, hostid in enumerate(create_result["hostids"])})
+    return hostids
+
+# Function to drop the proxy choices of hosts that were not created, so they do not count as proxy load
+def release_proxies(params):
+    for host_params in params:
+        proxy_registry.release(host_params["proxy_hostid"])
+
+# Function to mark the stored PSKs of created hosts as the keys in Zabbix, takes {host name: host ID or None}
+def confirm_psks(hostids):
+    try:
+        psk_store.confirm(hostids)
+    except sqlite3.Error as e:
+        # The keys stay pending in the store, they are still the keys sent to Zabbix
+        logging.error("PSKs of %s created hosts could not be confirmed: %s", len(hostids), e)
+
+# Function to move the stored PSKs of renamed hosts to their new names, takes {host ID: new host name}
+def rename_psks(host_names):
+    try:
+        psk_store.rename(host_names)
+    except sqlite3.Error as e:
+        logging.error("PSKs of %s renamed hosts could not be moved to their new names: %s", len(host_names), e)
+
+# Host creations from concurrent workers are collected and sent with one host.create request
+create_batcher = Batcher(zabbix_create_hosts, create_batch_size, create_batch_window)
+
+# Function to create a host in Zabbix through the API, concurrent creations are sent as one batch
+def zabbix_create_host_api(host_name, visible_name, proxy_group, ip_address, templates, groups):
+    host = {
+        "host_name": host_name,
+        "visible_name": visible_name,
+        "proxy_group": proxy_group,
+        "ip_address": ip_address,
+        "templates": templates,
+        "groups": groups
+    }
+    debug_dumps.dump("Host creation variables: %s", host)
+    return create_batcher.submit(host)
+
+# Function to create a host in Zabbix with the ansible playbook
+def zabbix_create_host_ansible(host_name, visible_name, proxy_group, ip_address, templates, groups):
+    try:
+        proxyid, proxy = proxy_registry.select(proxy_group) if proxy_group else ("0", "")
+    except KeyError as e:
+        logging.error("Host [%s] creation skipped: %s", visible_name, e)
+        return False
+    try:
+        psk_identity, psk = psk_store.stage([host_name])[host_name]
+    except sqlite3.Error as e:
+        logging.error("Host [%s] creation skipped: %s", visible_name, e)
+        proxy_registry.release(proxyid)
+        return False
     # Execute ansible playbook with extra variables
     ansible_start_command = [
         "ansible-playbook",
@@ -224,243 +509,396 @@ def zabbix_create_host(host_name, visible_name, proxy, ip_address, templates, gr
         f'host_name="{host_name}" visible_name="{visible_name}" proxy="{proxy}" ip="{ip_address}" link_templates="{templates}" host_groups="{groups}"',
         "zabbix_create_host.yml"
     ]
-    logging.info("Start of playbook zabbix_create_host")
-    logging.info(f"Ansible variables: \nhost_name = {host_name} \nvisible_name = {visible_name} \nip = {ip_address} \nproxy = {proxy} \nlink_templates = {templates} \nhost_groups = {groups}")
+    logging.info("Start of playbook zabbix_create_host for host [%s]", visible_name)
+    debug_dumps.dump("Ansible variables: host_name = %s, visible_name = %s, ip = %s, proxy = %s, link_templates = %s, host_groups = %s",
+                     host_name, visible_name, ip_address, proxy, templates, groups)
+    # The playbook uses the session of this process instead of logging in, the token and the PSK are not shown in the process list
+    ansible_environment = dict(os.environ, **ansible_api_environment, ZABBIX_AUTH_KEY=zabbix_client.auth or "", ZABBIX_TLS_PSK=psk,
+                               ZABBIX_TLS_PSK_IDENTITY=psk_identity)
     try:
-        result = subprocess.run(ansible_start_command, check=True)
-        logging.info(f"Host [{visible_name}] created successfully")
-        return  # Playbook executed successfully
-    except subprocess.CalledProcessError:
-        logging.critical(f"Host [{visible_name}] creation failed with with return code {e.returncode} and output: {e.output.decode()}") # Playbook execution failed
-        return
+        result = subprocess.run(ansible_start_command, check=True, env=ansible_environment)
+        logging.info("Host [%s] created successfully", visible_name)
+    except subprocess.CalledProcessError as e:
+        logging.critical("Host [%s] creation failed with with return code %s", visible_name, e.returncode) # Playbook execution failed
+        proxy_registry.release(proxyid)
+        return False
+    proxy_registry.commit(proxyid)
+    # The playbook does not return the host ID, the stored keys need it to follow the host when it is renamed
+    try:
+        hostid = next((host["hostid"] for host in zabbix_client.call("host.get", {"output": ["hostid"], "filter": {"host": [host_name]}})), None)
+    except ZabbixAPIError as e:
+        logging.warning("ID of the created host [%s] could not be read: %s", visible_name, e)
+        hostid = None
+    confirm_psks({host_name: hostid})
+    return True  # Playbook executed successfully
 
-# Function to handle incoming connection
-def handle_connection(client_socket):
-    logging.info("Start of handle_connection function")
-    # Handle connection and extract data from POST request
-    netbox_data = client_socket.recv(8192)
-    netbox_data = netbox_data.decode().strip()
-    # logging.info(netbox_data)
-    
-    if "\r\n\r\n" not in netbox_data:
-        logging.error("No header-body delimiter found")
-        response = ("HTTP/1.1 400 Bad Request\r\n\r\n")
-        client_socket.sendall(response.encode())
-        client_socket.close()
-        return
-    headers, body = netbox_data.split("\r\n\r\n", 1)
-    
-    if not headers.startswith("POST"):
-        logging.error("Received non-POST request")
-        response = ("HTTP/1.1 400 Bad Request\r\n\r\n")
-        client_socket.sendall(response.encode())
-        client_socket.close()
-        return 
-    
-    # Parse data from NetBox
-    try:        
-        netbox_host = json.loads(body)    
-    except json.JSONDecodeError:
+# Function to create a host in Zabbix with the configured backend
+def zabbix_create_host(host_name, visible_name, proxy_group, ip_address, templates, groups):
+    if create_backend == "ansible":
+        return zabbix_create_host_ansible(host_name, visible_name, proxy_group, ip_address, templates, groups)
+    return zabbix_create_host_api(host_name, visible_name, proxy_group, ip_address, templates, groups) is not None
+
+# Function to handle one HTTP request from NetBox, returns the response status and body
+def handle_request(request):
+    with http_in_flight.track(), correlation(new_correlation_id()):
+        response = route_request(request)
+    http_requests.inc(request.method if request.method in ("GET", "POST") else "other", str(response[0]))
+    return response
+
+# Function to answer a request by its method and path
+def route_request(request):
+    if request.method == "GET" and request.path == "/metrics":
+        return 200, metrics_registry.render(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    if request.method == "GET" and request.path == "/queue":
+        return 200, json.dumps(work_queue.stats()) + "\n", {"Content-Type": "application/json"}
+    if request.method == "GET" and request.path == "/health":
+        # Webhooks are accepted during the warm-up too, 503 only means they are not processed yet
+        health = dict(warm_up_state, status="ready" if service_ready.is_set() else "starting", host_index=len(host_index),
+                      zabbix_api={"breaker": zabbix_client.breaker.state(), "concurrency_limit": int(zabbix_client.limiter.limit)})
+        return 200 if service_ready.is_set() else 503, json.dumps(health) + "\n", {"Content-Type": "application/json"}
+    if request.method != "POST":
+        logging.error("Received %s request", request.method)
+        return 405, "Only POST requests are accepted\n", {"Allow": "POST"}
+
+    # Parse data from NetBox, json.loads() reads the body bytes directly
+    try:
+        with stage_latency.time("parse"):
+            netbox_host = json.loads(request.body)
+    except ValueError:
         logging.error("Invalid JSON data")
-        response = ("HTTP/1.1 400 Bad Request\r\n\r\n")
-        client_socket.sendall(response.encode())
-        client_socket.close()
-        return
-    
-    linux_fam = ["linux", "centos", "debian", "ubuntu"]
-    templates = []
-    groups = []
+        return 400, "Invalid JSON data\n"
+    # Webhooks without VM data could never be processed, they are not stored
+    if not isinstance(netbox_host, dict) or not isinstance(netbox_host.get("data"), dict):
+        logging.error("Webhook without VM data")
+        return 400, "Webhook without VM data\n"
+
+    # Acknowledge as soon as the webhook is on disk, it is processed after the coalescing window
+    # A waiting webhook of the same VM is replaced, so only the latest one is processed
+    vm_id = netbox_host["data"].get("id")
+    try:
+        with stage_latency.time("enqueue"):
+            work_queue.put(f"vm:{vm_id}" if vm_id is not None else None, netbox_host, delay=coalesce_window,
+                           correlation_id=correlation_id.get())
+    except sqlite3.Error as e:
+        logging.error("Webhook could not be stored in the work queue: %s", e)
+        return 503, "Work queue is not available\n"
+    logging.info("Webhook for VM %s queued, NetBox request_id %s", vm_id, netbox_host.get("request_id"))
+    return 202, b""
 
-#    logging.info(json.dumps(netbox_host, indent=4))
+# Function to assign templates, groups and proxy to a NetBox VM with the rules from classification_rules.json
+# Returns (netbox_host, None) or (None, reason) when the VM must not be monitored
+def classify_netbox_vm(vm):
+    return classification_rules.classify(vm)
 
-    # IP address set with netmask discard if there is one
+# Function to load the classification rules again on SIGHUP (systemctl reload), the old rules stay on errors
+def reload_classification_rules(signum, frame):
+    global classification_rules
     try:
-        ip_address = netbox_host.get("data", {}).get("primary_ip", {}).get("address")
-        if "/" in ip_address: ip_address = ip_address.split('/')[0]
-        logging.info(f"IP address retrieved successfully {ip_address}")
-    except Exception as e:
-        logging.info(f"IP address retrieve failed with error: {e}")
+        classification_rules = ClassificationRules.from_file(rules_path)
+    except RuleError as e:
+        logging.error("Classification rules were not reloaded: %s", e)
         return
+    proxy_registry.set_groups(classification_rules.proxy_groups())
+    logging.info("Classification rules reloaded from %s", rules_path)
+    # Names added to the rules are resolved before the next webhook needs them
+    threading.Thread(target=get_templates_groups_proxies_id, name="id-reload", daemon=True).start()
+
+# Function to process webhook data from NetBox and create or update the host in Zabbix
+# Returns False when a Zabbix request failed and the webhook should be retried
+def process_netbox_host(netbox_host):
+    vm = netbox_host.get("data") or {}
+    with stage_latency.time("classify"):
+        netbox_host, reason = classify_netbox_vm(vm)
+    if netbox_host is None:
+        logging.error("VM %s is not processed: %s", vm.get('name'), reason)
+        webhook_outcomes.inc("rejected")
+        # Reasons with a site name are counted together, so the number of label values stays small
+        rejected_webhooks.inc(reason.split(' "')[0])
+        return True
+    ip_address = netbox_host["ip"]
+    logging.info("VM %s with IP %s classified with templates %s and groups %s", netbox_host['visiblename'], ip_address, netbox_host['templates'], netbox_host['groups'])
+
+    # Serialize creates and updates of the same host between workers
+    lock_keys = [f"ip:{ip_address}"]
+    if vm.get("id") is not None:
+        lock_keys.append(f"vm:{vm['id']}")
+    lock_wait_started = time.perf_counter()
+    with host_locks.hold(*lock_keys):
+        stage_latency.observe(time.perf_counter() - lock_wait_started, "lock_wait")
+        # Webhooks that only changed VM fields Zabbix does not use end here, while the host is still in the index
+        vm_key = str(vm["id"]) if vm.get("id") is not None else None
+        host_fingerprint = fingerprint(netbox_host)
+        if vm_key is not None:
+            if fingerprint_cache.matches(vm_key, host_fingerprint) and ip_address in host_index:
+                logging.info('Zabbix host "%s" has no changes since it was last synchronized', netbox_host['visiblename'])
+                fingerprint_lookups.inc("hit")
+                webhook_outcomes.inc("unchanged")
+                return True
+            fingerprint_lookups.inc("miss")
+        synchronized = synchronize_zabbix_host(netbox_host, ip_address)
+        # Only a state that is in Zabbix is remembered, after a failure the next webhook is compared again
+        if vm_key is not None:
+            if synchronized:
+                fingerprint_cache.put(vm_key, host_fingerprint)
+            else:
+                fingerprint_cache.invalidate(vm_key)
+        return synchronized
+
+# Function to create or update the Zabbix host of a classified VM, called with the host lock held
+# Returns False when a Zabbix request failed
+def synchronize_zabbix_host(netbox_host, ip_address):
+    # Hosts from the index are compared without a request to Zabbix, most webhooks end here
+    with stage_latency.time("index_lookup"):
+        indexed_host = host_index.lookup(ip_address)
+        up_to_date = indexed_host is not None and not check_zabbix_accuracy(indexed_host, netbox_host)[0]
+    if up_to_date:
+        logging.info('Zabbix host "%s" already exists and up to date', netbox_host['visiblename'])
+        webhook_outcomes.inc("up_to_date")
+        return True
+
+    # Creates and updates are decided on data from Zabbix, so a stale index entry can't cause a duplicate host
+    logging.debug("Start of check_ip_in_zabbix() function")
+    with stage_latency.time("check_ip_in_zabbix"):
+        zabbix_host = check_ip_in_zabbix(ip_address)
+    logging.debug("End of check_ip_in_zabbix() function")
+
+    if zabbix_host is None:
+        logging.info("Processing stopped due to the error mentioned above")
+        webhook_outcomes.inc("failed")
+        return False
+    elif zabbix_host:
+        debug_dumps.dump("Zabbix_host = %s, Netbox_host = %s", zabbix_host, netbox_host)
+        # Check if the Zabbix host is up to date
+        logging.debug("Execution of check_zabbix_accuracy function")
+        check_zabbix_accuracy_result = check_zabbix_accuracy(zabbix_host, netbox_host)
+        if not check_zabbix_accuracy_result[0]: # changes variable (boolean)
+            logging.info('Zabbix host "%s" already exists and up to date', netbox_host['visiblename'])
+            webhook_outcomes.inc("up_to_date")
+            return True
+        else:
+            # Update the Zabbix host with only the changed fields, templates and groups
+            updated_zabbix_host = check_zabbix_accuracy_result[1] # zabbix_host variable
+            fields_change = check_zabbix_accuracy_result[2] # fields_change variable
+            templates_change = check_zabbix_accuracy_result[3] # templates_change variable
+            groups_change = check_zabbix_accuracy_result[4] # groups_change variable
         
-    # Exclude Test cluster from processing
-    try:
-        cluster = netbox_host.get("data", {}).get("cluster")
-        logging.info(f"Cluster retrieve successfully: {cluster.get('name')}")
-        if cluster and "test" in cluster.get("name", "").lower():
-            logging.error("VM is in Test cluster, no need to process")
-            response = ("HTTP/1.1 400 Bad Request\r\n\r\n")
-            client_socket.sendall(response.encode())
-            return
-    except Exception as e:
-        logging.info(f"Error while processing cluster information: {e}")
-    
-    # Tags set
+            logging.debug("Start of zabbix_update_host() function")
+            with stage_latency.time("zabbix_update_host"):
+                updated = zabbix_update_host(updated_zabbix_host, fields_change, templates_change, groups_change)
+            webhook_outcomes.inc("updated" if updated else "failed")
+            return updated
+    else:
+        # Create a new host in Zabbix if it doesn't exist
+        logging.debug("Start of zabbix_create_host() function")
+        with stage_latency.time(f"zabbix_create_host_{create_backend}"):
+            created = zabbix_create_host(netbox_host["hostname"], netbox_host["visiblename"], netbox_host["proxy_group"], ip_address, netbox_host["templates"], netbox_host["groups"])
+        logging.debug("End of zabbix_create_host() function")
+        webhook_outcomes.inc("created" if created else "failed")
+        return created
+
+# Function to process one queued webhook in a worker thread, failed webhooks are retried later
+def process_queue_entry(entry_id, key, netbox_host, received, webhook_id):
+    stage_latency.observe(max(time.time() - received, 0), "queue_wait")
+    # Retry and dead_letter lines of the work queue are written with the correlation id of the webhook too
     try:
-        tags_data = netbox_host.get("data", {}).get("tags", [])
-        tags = [tag["name"].lower() for tag in tags_data] # Creates array from "name" fields in tag_data dictionary
-        logging.info("Tags retrieved successfully")
-        # Check if the virtual machine is in an orphaned state (indicating that it will be shut down and should not proceed)
-        if "orphaned" in tags: 
-            logging.error("VM is in orphaned state, no need to process")
-            response = ("HTTP/1.1 400 Bad Request\r\n\r\n")
-            client_socket.sendall(response.encode())
-            client_socket.close()
-            return
-    except Exception as e:
-        logging.info(f"Tags retrieve failed with error: {e}")
-        
-    if ip_address and netbox_host.get("data", {}).get("status", {}).get("value").lower() == "active":
+        with correlation(webhook_id):
+            error = None
+            try:
+                with webhooks_in_progress.track(), stage_latency.time("process"):
+                    processed = process_netbox_host(netbox_host)
+            except Exception as e:
+                logging.error("Error in process_netbox_host() function: %s", e)
+                webhook_outcomes.inc("error")
+                processed, error = False, e
+            try:
+                if error is not None:
+                    work_queue.fail(entry_id, error)
+                elif processed:
+                    work_queue.ack(entry_id)
+                elif zabbix_client.breaker.state() != "closed":
+                    # Zabbix is unavailable, the webhook waits for the next test request without using up its attempts
+                    work_queue.fail(entry_id, "Zabbix API unavailable", delay=zabbix_client.breaker.retry_in() or zabbix_client.breaker.cooldown)
+                else:
+                    work_queue.fail(entry_id, "Zabbix request failed")
+            except sqlite3.Error as e:
+                # The claim is given back, so the webhook is processed again instead of waiting for a restart
+                logging.error("Result of the webhook could not be stored in the work queue: %s", e)
+                try:
+                    work_queue.release(entry_id)
+                except sqlite3.Error as e:
+                    logging.error("Work queue entry %s stays claimed until the next start: %s", entry_id, e)
+    finally:
+        free_workers.release()
 
-        # Check the platform and visible name to assign a template and group
-        visible_name = netbox_host.get("data", {}).get("name")
-        platform = netbox_host.get("data", {}).get("platform", {}).get("name").lower()
+# Function to give due webhooks from the work queue to the processing workers until shutdown
+def dispatch_queue(report_interval=300):
+    last_report = time.monotonic()
+    while not shutdown_requested.is_set():
+        # During the warm-up webhooks are only queued
+        if not service_ready.wait(1):
+            continue
+        # While the circuit breaker is open webhooks stay in the queue
+        # After the cooldown they are processed one at a time until a request to Zabbix succeeds
+        if not zabbix_client.breaker.available():
+            shutdown_requested.wait(min(max(zabbix_client.breaker.retry_in(), 0.1), 1))
+            continue
+        half_open = zabbix_client.breaker.state() != "closed"
+        # Entries are only claimed for free workers, claimed entries are not collapsed with newer webhooks
+        if not free_workers.acquire(timeout=1):
+            continue
+        free = 1
+        while free < (1 if half_open else max_workers) and free_workers.acquire(blocking=False):
+            free += 1
+        try:
+            entries = work_queue.claim(free)
+        except sqlite3.Error as e:
+            logging.error("Webhooks could not be claimed from the work queue: %s", e)
+            entries = []
+            shutdown_requested.wait(1)
+        for _ in range(free - len(entries)):
+            free_workers.release()
+        for entry_id, key, netbox_host, attempts, received, webhook_id in entries:
+            job = processing_pool.submit(process_queue_entry, entry_id, key, netbox_host, received, webhook_id)
+            if half_open:
+                job.result()
+        if time.monotonic() - last_report >= report_interval:
+            stats = work_queue.stats()
+            if stats["depth"] or stats["dead_letter"] or stats["received"]:
+                logging.info("Work queue: %s", stats)
+            last_report = time.monotonic()
 
-        # Checking for EBAY flag
-        if "ebay" in visible_name.lower():
-            logging.info("EBAY host, no need for monitoring")
-            return 
-        
-        if "windows" in platform:
-            templates.append("Template OS Windows")
-            groups.extend(["Allwindows", "Windows General"])
-            logging.info("Windows template and groups appended")
-        elif any(os in platform for os in linux_fam): 
-            templates.append("Template OS Linux")
-            groups.append("Linux servers")
-            logging.info("Linux template and group appended")
-            # Additional check for cPanel mentions in the name to append backup monitoring
-            if " cp " in visible_name.lower() or "cpanel" in visible_name.lower() or re.search(r"cp\d{2}", visible_name.lower()):
-                templates.append("template cPanel backup")
-                groups.append("cPanels")
-                logging.info("cPanel template and groups appended")
-        else: 
-            logging.error(f"There are no matches with the platform type")
-            logging.info("Connection closed")
-            response = ("HTTP/1.1 422 Unprocessable Entity\r\n\r\n")
-            client_socket.sendall(response.encode())
-            client_socket.close()
-            return       
-
-        # Check extra information in tags to assign templates and groups
-        for tag in tags:
-            if tag == "uniq": 
-                groups.append("Uniq")
-                logging.info("Uniq group appended")
-            if tag == "cpanel":
-                groups.append("cPanels")
-                templates.append("template cPanel backup")
-                logging.info("cPanel template and group appended")   
-
-        host_name = netbox_host.get("data", {}).get("custom_fields", {}).get("vcsa_vm_guest_hostname")
-        if host_name is not None:
-            logging.info(f"Hostname retrieved successfully")
-        else: 
-            # Set visible name as a hostname
-            host_name = visible_name
-            logging.info("Hostname is empty, visible name assigned as hostname")
-        
-        location = netbox_host.get("data", {}).get("site", {}).get("name").lower()       
-
-        # Extract the location information and set "proxy" variable
-        if ip_address.startswith("172."): 
-                    if "pluto-vcenter" in location: 
-                        proxy = "62.90.18.89"
-                    elif "jupiter-vcenter" in location:
-                        proxy = "80.178.113.59"
-        else: 
-            proxy = ""
-            # Check if the IP address exists in Zabbix
-        
-        logging.info("Start of check_ip_in_zabbix() function")
-        zabbix_host = check_ip_in_zabbix(ip_address, client_socket)
-        logging.info("End of check_ip_in_zabbix() function")
-        
-        if zabbix_host is None:
-            logging.info("Connection closed due to the error mentioned above")
-            client_socket.close()
+# Received webhooks are stored here first, pending entries are replayed after a restart
+# Opened by main(), the entries claimed by the previous run of the service are replayed then
+work_queue = None
+Gauge("zabbix_suite_queue_depth", "Webhooks in the work queue, in progress included", function=lambda: work_queue.stats()["depth"])
+Gauge("zabbix_suite_queue_oldest_age_seconds", "Age of the oldest webhook in the work queue", function=lambda: work_queue.stats()["oldest_age_seconds"])
+Gauge("zabbix_suite_queue_dead_letter", "Webhooks in the dead_letter table", function=lambda: work_queue.stats()["dead_letter"])
+Counter("zabbix_suite_queue_received_total", "Webhooks stored in the work queue", function=lambda: work_queue.received)
+Counter("zabbix_suite_queue_collapsed_total", "Webhooks replaced by a newer one of the same VM while they waited", function=lambda: work_queue.collapsed)
+Counter("zabbix_suite_queue_dispatched_total", "Webhooks given to the workers, retries included", function=lambda: work_queue.dispatched)
+
+# Function to return the lookup caches that are saved in the snapshot
+def snapshot_parts():
+    return {"templates": template_registry, "groups": group_registry, "proxies": proxy_registry, "hosts": host_index}
+
+# Function to save the lookup caches periodically, only caches loaded from Zabbix are saved
+def start_snapshots(interval):
+    def snapshot_loop():
+        while not shutdown_requested.wait(interval):
+            save_snapshot(snapshot_path, snapshot_parts())
+    threading.Thread(target=snapshot_loop, name="cache-snapshot", daemon=True).start()
+
+# Function to mark the service ready, webhooks in the work queue are processed from now on
+def set_ready():
+    warm_up_state["ready_seconds"] = round(time.time() - warm_up_state["started"], 3)
+    service_ready.set()
+    logging.info(f"Ready to process webhooks {warm_up_state['ready_seconds']}s after start, caches from {warm_up_state['caches']}")
+    notify(f"STATUS=Processing webhooks, caches from {warm_up_state['caches']}")
+
+# Function to log in to Zabbix and load the lookup caches, runs while the listener already accepts webhooks
+def warm_up():
+    loaded = bool(snapshot_path) and load_snapshot(snapshot_path, snapshot_parts(), snapshot_max_age)
+    if loaded:
+        warm_up_state["caches"] = "snapshot"
+
+    # Zabbix authentication with retries, webhooks received meanwhile wait in the work queue
+    # The token is kept by the shared Zabbix API client and renewed when the session expires
+    logging.info("Zabbix authentication start")
+    delay = 1
+    while zabbix_authentication() != True:
+        logging.error(f"Zabbix authentication failed, next attempt in {delay} seconds")
+        notify(f"STATUS=Zabbix authentication failed, next attempt in {delay} seconds")
+        if shutdown_requested.wait(delay):
             return
-        elif zabbix_host: 
-            # Create a dictionary with NetBox host information
-            netbox_host = {
-                "hostname": host_name,
-                "visiblename": visible_name,
-                "ip" : ip_address,
-                "templates": templates,
-                "groups": groups
-            }
-            logging.info(f"Zabbix_host = {zabbix_host}")
-            logging.info(f"Netbox_host = {netbox_host}")
-            # Check if the Zabbix host is up to date
-            logging.info("Execution of check_zabbix_accuracy function")
-            check_zabbix_accuracy_result = check_zabbix_accuracy(zabbix_host, netbox_host)
-            if not check_zabbix_accuracy_result[0]: # changes variable (boolean)
-                logging.info(f"Zabbix host \"{netbox_host['visiblename']}\" already exists and up to date")
-                return
-            else:
-                # Update the Zabbix host with new information 
-                updated_zabbix_host = check_zabbix_accuracy_result[1] # zabbix_host variable
-                templates_change = check_zabbix_accuracy_result[2] # templates_change variable
-                groups_change = check_zabbix_accuracy_result[3] # groups_change variable
-                
-                logging.info("Start of zabbix_update_host() function")
-                zabbix_update_host(updated_zabbix_host, templates_change, groups_change)
-                return
-        else:
-            # Create a new host in Zabbix if it doesn't exist
-            logging.info("Start of zabbix_create_host() function")
-            zabbix_create_host(host_name, visible_name, proxy, ip_address, templates, groups)
-            logging.info("End of zabbix_create_host() function")
-            logging.info("Connection closed")
-            client_socket.close()
+        delay = min(delay * 2, 60)
+    warm_up_state["authenticated"] = True
+
+    # IDs (one batch request) and the host index are loaded at the same time
+    # With a snapshot the service is ready now and the caches are checked against Zabbix in the background
+    # Loaders that failed are run again, the caches keep the snapshot data (or load on demand) meanwhile
+    results = {}
+    loaders = {"ids": get_templates_groups_proxies_id, "hosts": host_index.warm}
+    delay = 1
+    while True:
+        threads = [threading.Thread(target=lambda name=name, loader=loader: results.update({name: loader()}), name=f"warm-up-{name}")
+                   for name, loader in loaders.items() if not results.get(name)]
+        for thread in threads:
+            thread.start()
+        if loaded and not service_ready.is_set():
+            set_ready()
+        for thread in threads:
+            thread.join()
+        if not service_ready.is_set():
+            set_ready()
+        failed = [name for name in loaders if not results.get(name)]
+        if not failed:
+            break
+        logging.warning(f"Loading {', '.join(failed)} from Zabbix failed, next attempt in {delay} seconds")
+        notify(f"STATUS=Processing webhooks, caches from {warm_up_state['caches']}, loading {', '.join(failed)} from Zabbix failed")
+        if shutdown_requested.wait(delay):
             return
-    else:
-        logging.error("Invalid data format or VM not active")
-        return
-        # # Send the response back to the client
-        # logging.info("Connection closed")
-        # client_socket.close()
-        # return
+        delay = min(delay * 2, 60)
+    warm_up_state["caches"] = "zabbix"
+    warm_up_state["revalidated"] = True
+    notify("STATUS=Processing webhooks, caches from zabbix")
+
+    start_id_refresh(id_cache_ttl / 2)
+    proxy_registry.start_refresh(proxy_refresh, shutdown_requested)
+    host_index.start_refresh(host_index_refresh, host_index_full_refresh, shutdown_requested)
+    if snapshot_path and warm_up_state["revalidated"]:
+        save_snapshot(snapshot_path, snapshot_parts())
+        start_snapshots(snapshot_interval)
+
+# Function to stop accepting new connections when systemd stops the service
+def request_shutdown(signum, frame):
+    logging.info(f"Signal {signum} received, finishing in-flight webhooks")
+    notify("STOPPING=1")
+    shutdown_requested.set()
 
 # Main function with socket set
 def main(): 
-    #Listen on port 17777 and open a socket    
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(("0.0.0.0", 17777))
-        server_socket.listen(10)
-        while True:
-            try:
-                client_socket, client_addr = server_socket.accept()
-                logging.info(f"Connection from {client_addr}")
-                try:
-                    handle_connection(client_socket)
-                except Exception as e:
-                    logging.error(f"Error in handle_connection() function: {e}")
-                finally:
-                    logging.info("Connection closed from handle_connection() function")
-                    client_socket.close()             
-            except Exception as e:
-                logging.error(f"Error in main() function: {e}")
-                time.sleep(1)
-            # finally:
-            #     logging.info("Connection closed from the main() function")
-            #     client_socket.close()
+    global fingerprint_cache, psk_store, work_queue
+    logging.info("Script starting up...")
+    work_queue = WorkQueue(queue_path, max_attempts=max_attempts, retry_base=retry_base, retry_max=retry_max)
+    work_queue.replay_claimed()
+    fingerprint_cache = FingerprintCache(fingerprint_cache_size, fingerprint_cache_ttl, fingerprint_cache_path or None)
+    psk_store = PskStore()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGHUP, reload_classification_rules)
+    # Listen on port 17777, idle keep-alive connections from nginx wait in a selector without a worker
+    server = HTTPServer(("0.0.0.0", 17777), handle_request, connection_pool, backlog=listen_backlog,
+                        client_timeout=client_timeout, keepalive_timeout=keepalive_timeout, max_body_size=max_body_size)
+    logging.info(f"Listening on port 17777 with {max_workers} workers")
+    # systemd gets READY=1 as soon as webhooks are accepted, the warm-up is only reported with STATUS= and /health
+    notify("READY=1\nSTATUS=Accepting webhooks, warming up")
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    dispatcher = threading.Thread(target=dispatch_queue, name="queue-dispatcher", daemon=True)
+    dispatcher.start()
+    try:
+        server.serve(shutdown_requested)
+    except Exception as e:
+        logging.error(f"Error in main() function: {e}")
 
-# The very start of the script
-logging.info("Script starting up...")
-if __name__ == '__main__':
-    # Zabbix authentication with retries if failed
-    logging.info(f"Zabbix authentication start")
-    zabbix_authentication_result = zabbix_authentication()        
-    if zabbix_authentication_result == True:
-        # Zabbix authentication check
-        with open("auth/zabbix_auth.txt", "r") as auth_file:
-            auth_key = auth_file.read()
+    # Webhooks still waiting in the work queue stay there and are processed after the restart
+    connection_pool.drain(client_timeout)
+    work_queue.close()
+    dispatcher.join()
+    logging.info(f"Waiting for {processing_pool.in_flight()} in-flight webhooks")
+    if processing_pool.drain(drain_timeout):
+        logging.info("All in-flight webhooks finished")
     else:
-        logging.critical("Script terminated due to previous errors")
-        sys.exit(1)
+        logging.warning(f"In-flight webhooks did not finish within {drain_timeout} seconds")
+    fingerprint_cache.close()
+    psk_store.close()
+    # Caches that were never checked against Zabbix are not saved, the snapshot would look newer than its data
+    if snapshot_path and warm_up_state["revalidated"]:
+        save_snapshot(snapshot_path, snapshot_parts())
+    if warm_up_state["authenticated"]:
+        token_manager.logout()
+    logging.info("Script shutting down...")
 
-    get_templates_id()
-    get_groups_id()
+# The very start of the script
+if __name__ == '__main__':
+    # The port is bound before the warm-up, so webhooks sent during a restart are not refused
     main()
-logging.info("Script shutting down...")
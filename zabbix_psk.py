@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from zabbix_api import zabbix_client, ZabbixAPIError, ZabbixConnectionError, ZabbixUnavailableError
+from zabbix_auth import zabbix_authentication, token_manager
+from worker_pool import WorkerPool
+from psk_store import PskStore, psk_store_path
+
+# Totals are updated by several worker threads
+totals_lock = threading.Lock()
+
+
+# Function to read the hosts the Zabbix server connects to with PSK, all of them or the given host names
+def get_psk_hosts(host_names=None):
+    params = {"output": ["hostid", "host"], "filter": {"tls_connect": 2}}
+    if host_names:
+        params["filter"]["host"] = host_names
+    return zabbix_client.call("host.get", params)
+
+
+# Function to rotate the keys of one batch of hosts with one JSON-RPC batch request
+# host.massupdate would give every host of the batch the same key, so every host gets its own host.update call
+def rotate_batch(hosts, store, totals):
+    try:
+        # Hosts that are not in the store were created with -PSK01
+        keys = store.stage([host["host"] for host in hosts], first_serial=2)
+    except sqlite3.Error as e:
+        logging.error(f"New keys of {len(hosts)} hosts could not be stored, the hosts are skipped: {e}")
+        with totals_lock:
+            totals["failed"] += len(hosts)
+        return
+    calls = [("host.update", {"hostid": host["hostid"], "tls_psk_identity": keys[host["host"]][0], "tls_psk": keys[host["host"]][1]})
+             for host in hosts]
+    unknown = 0
+    try:
+        results = zabbix_client.batch(calls)
+    except ZabbixUnavailableError as e:
+        results = [e] * len(hosts)
+    except ZabbixConnectionError as e:
+        # The request may have been applied, the new keys stay pending in the store
+        logging.error(f"Key rotation of {len(hosts)} hosts has an unknown result, their new keys are pending in the store: {e}")
+        results = [None] * len(hosts)
+        unknown = len(hosts)
+    except ZabbixAPIError as e:
+        results = [e] * len(hosts)
+    rotated = {}
+    for host, result in zip(hosts, results):
+        if isinstance(result, ZabbixAPIError):
+            logging.error(f"Key of host {host['host']} was not rotated: {result}")
+        elif result is not None:
+            rotated[host["host"]] = host["hostid"]
+    try:
+        store.confirm(rotated)
+    except sqlite3.Error as e:
+        logging.error(f"Rotated keys of {len(rotated)} hosts could not be confirmed, they stay pending in the store: {e}")
+    with totals_lock:
+        totals["requests"] += 1
+        totals["rotated"] += len(rotated)
+        totals["unknown"] += unknown
+        totals["failed"] += len(hosts) - len(rotated) - unknown
+
+
+# Function to log the progress of the rotation until stop_event is set
+def report_progress(totals, total, started, interval, stop_event):
+    while not stop_event.wait(interval):
+        with totals_lock:
+            done = totals["rotated"] + totals["failed"] + totals["unknown"]
+        elapsed = time.monotonic() - started
+        message = f"Key rotation: {done}/{total} hosts ({done / max(total, 1):.0%}), {done / max(elapsed, 1e-9):.0f} hosts/s"
+        logging.info(message)
+        print(message, file=sys.stderr)
+
+
+# Function to generate new keys for Zabbix hosts and send them in batches
+def rotate(args, store):
+    if zabbix_authentication() != True:
+        sys.exit("Zabbix authentication failed, see the log for details")
+    try:
+        hosts = get_psk_hosts(args.host)
+    except ZabbixAPIError as e:
+        sys.exit(f"Reading hosts from Zabbix failed: {e}")
+    logging.info(f"Key rotation of {len(hosts)} hosts started{' (dry run)' if args.dry_run else ''}")
+
+    totals = Counter()
+    started = time.monotonic()
+    if not args.dry_run:
+        stop_progress = threading.Event()
+        threading.Thread(target=report_progress, args=(totals, len(hosts), started, args.progress_interval, stop_progress),
+                         name="progress", daemon=True).start()
+        # Blocks when all workers are busy, the API client limits the requests to Zabbix as well
+        pool = WorkerPool(args.workers, args.workers)
+        jobs = []
+        for start in range(0, len(hosts), args.batch_size):
+            batch = hosts[start:start + args.batch_size]
+            jobs.append((pool.submit(rotate_batch, batch, store, totals), batch))
+        pool.drain(None)
+        stop_progress.set()
+        # A batch that stopped with an error may have been sent, Zabbix may have the new or the old keys
+        for job, batch in jobs:
+            try:
+                job.result()
+            except Exception as e:
+                logging.error(f"Key rotation of {len(batch)} hosts stopped with an error, the result is unknown: {e}")
+                totals["unknown"] += len(batch)
+    token_manager.logout()
+
+    finished = time.monotonic()
+    report = {
+        "dry_run": args.dry_run,
+        "hosts": len(hosts),
+        "rotated": totals["rotated"],
+        "failed": totals["failed"],
+        # Hosts of requests without an answer, Zabbix may have the new or the old key
+        "unknown": totals["unknown"],
+        "batch_requests": totals["requests"],
+        "total_seconds": round(finished - started, 2),
+        "hosts_per_second": round(totals["rotated"] / max(finished - started, 1e-9), 1)
+    }
+    logging.info(f"Key rotation finished: {report}")
+    print(json.dumps(report, indent=4), file=sys.stderr)
+    if totals["rotated"]:
+        print("Agents need the new keys, write them with: zabbix_psk.py export --output <file>", file=sys.stderr)
+
+
+# Function to write the stored keys as JSON Lines, for the configuration of the agents
+def export(args, store):
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(os.open(args.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+    for entry in store.entries(args.host):
+        output.write(json.dumps(entry) + "\n")
+    if output is not sys.stdout:
+        output.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rotate the PSKs of Zabbix hosts or export the stored keys")
+    parser.add_argument("--store", default=psk_store_path, help=f"PSK store file (default: {psk_store_path})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rotate_parser = subparsers.add_parser("rotate", help="generate new keys and send them to Zabbix with batched host.update calls")
+    rotate_parser.add_argument("--host", action="append", help="host name, can be repeated (default: all hosts with PSK encryption)")
+    rotate_parser.add_argument("--dry-run", action="store_true", help="only count the hosts, do not change keys")
+    rotate_parser.add_argument("--batch-size", type=int, default=100, help="host.update calls per batch request")
+    rotate_parser.add_argument("--workers", type=int, default=4, help="batch requests sent to Zabbix at the same time")
+    rotate_parser.add_argument("--progress-interval", type=float, default=5, help="seconds between progress lines")
+    export_parser = subparsers.add_parser("export", help="write the stored keys as JSON Lines")
+    export_parser.add_argument("--host", action="append", help="host name, can be repeated (default: all hosts)")
+    export_parser.add_argument("--output", default="-", help="file for the keys, created with mode 0600 (default: standard output)")
+    args = parser.parse_args()
+
+    store = PskStore(args.store)
+    try:
+        if args.command == "rotate":
+            rotate(args, store)
+        else:
+            export(args, store)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
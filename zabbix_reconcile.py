@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+import requests
+from zabbix_auth import zabbix_authentication, token_manager
+from worker_pool import WorkerPool
+from psk_store import PskStore
+from work_queue import WorkQueue
+import zabbix_hosts
+from zabbix_hosts import (classify_netbox_vm, check_zabbix_accuracy, zabbix_create_hosts, zabbix_update_hosts,
+                          get_templates_groups_proxies_id, host_index, update_calls, update_calls_replaced, queue_path)
+
+# NetBox API is used when the export is read from NetBox itself instead of a file
+netbox_token = os.environ.get("NETBOX_TOKEN")
+
+# Totals are updated by several worker threads
+totals_lock = threading.Lock()
+
+
+# Function to read objects from a JSON array one by one, without loading the whole file
+# Works with a plain array and with a NetBox API page ({"results": [...]})
+def iter_json_array(export_file, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    while True:
+        chunk = export_file.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        if not started:
+            if buffer.lstrip().startswith("{"):
+                results_key = buffer.find('"results"')
+                start = buffer.find("[", results_key) if results_key != -1 else -1
+            else:
+                start = buffer.find("[")
+            if start == -1:
+                if not chunk:
+                    raise ValueError("No JSON array found in the export")
+                continue
+            position = start + 1
+            started = True
+        while True:
+            # Skip whitespace and separators between objects
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break  # The object continues in the next chunk
+            position = end
+            yield item
+        if not chunk:
+            return
+
+
+# Function to read NetBox VMs from an export file (JSON array or JSON Lines) or from the paged NetBox API
+def iter_netbox_vms(source, page_size=1000):
+    if source.startswith("http://") or source.startswith("https://"):
+        session = requests.Session()
+        if netbox_token:
+            session.headers["Authorization"] = f"Token {netbox_token}"
+        url = f"{source.rstrip('/')}/api/virtualization/virtual-machines/?limit={page_size}"
+        while url:
+            response = session.get(url, timeout=60)
+            response.raise_for_status()
+            page = response.json()
+            yield from page["results"]
+            url = page.get("next")
+        return
+    with open(source, "r") as export_file:
+        if source.endswith(".jsonl"):
+            for line in export_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(export_file)
+
+
+# Function to compare one NetBox VM with the Zabbix hosts, returns a plan entry
+def plan_vm(item, seen_ips):
+    # Recorded webhooks are accepted as well as plain VM objects
+    vm = item.get("data", {}) if "event" in item else item
+    netbox_host, reason = classify_netbox_vm(vm)
+    if netbox_host is None:
+        return {"action": "skip", "vm": vm.get("name"), "reason": reason}
+    if netbox_host["ip"] in seen_ips:
+        return {"action": "skip", "vm": vm.get("name"), "reason": f"duplicate IP address {netbox_host['ip']}"}
+    seen_ips.add(netbox_host["ip"])
+    zabbix_host = host_index.lookup(netbox_host["ip"])
+    if zabbix_host is None:
+        return {"action": "create", "vm": vm.get("name"), "host": netbox_host}
+    changes, updated_zabbix_host, fields_change, templates_change, groups_change = check_zabbix_accuracy(zabbix_host, netbox_host)
+    if not changes:
+        return {"action": "noop", "vm": vm.get("name")}
+    return {"action": "update", "vm": vm.get("name"), "host": updated_zabbix_host, "fields_change": fields_change,
+            "templates_change": templates_change, "groups_change": groups_change}
+
+
+# Function to create one batch of hosts
+def apply_creates(entries, totals):
+    hosts = [{
+        "host_name": entry["host"]["hostname"],
+        "visible_name": entry["host"]["visiblename"],
+        "proxy_group": entry["host"]["proxy_group"],
+        "ip_address": entry["host"]["ip"],
+        "templates": entry["host"]["templates"],
+        "groups": entry["host"]["groups"]
+    } for entry in entries]
+    hostids = zabbix_create_hosts(hosts)
+    with totals_lock:
+        totals["created"] += sum(1 for hostid in hostids if hostid is not None)
+        totals["failed"] += sum(1 for hostid in hostids if hostid is None)
+
+
+# Function to update one batch of hosts
+def apply_updates(entries, totals):
+    updated = zabbix_update_hosts([(entry["host"], entry["fields_change"], entry["templates_change"], entry["groups_change"])
+                                   for entry in entries])
+    with totals_lock:
+        totals["updated"] += sum(updated)
+        totals["failed"] += len(updated) - sum(updated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a NetBox VM export with Zabbix hosts and create or update the hosts that differ")
+    parser.add_argument("source", nargs="?", help="NetBox VM export (.json or .jsonl) or NetBox URL (token in NETBOX_TOKEN)")
+    parser.add_argument("--dry-run", action="store_true", help="only write the plan, do not change Zabbix")
+    parser.add_argument("--plan", default="-", help="file for the plan in JSON Lines format (default: standard output)")
+    parser.add_argument("--batch-size", type=int, default=100, help="hosts per host.create or batch host.update request")
+    parser.add_argument("--workers", type=int, default=4, help="batches sent to Zabbix at the same time")
+    parser.add_argument("--requeue-dead", action="store_true", help="move the webhooks of the dead_letter table back to the work queue and exit")
+    args = parser.parse_args()
+
+    # The running service picks the webhooks up from the queue file
+    if args.requeue_dead:
+        requeued = WorkQueue(queue_path).requeue_dead()
+        logging.info(f"{requeued} webhooks moved from dead_letter back to the work queue {queue_path}")
+        print(f"{requeued} webhooks moved from dead_letter back to the work queue", file=sys.stderr)
+        return
+    if args.source is None:
+        parser.error("the source is required without --requeue-dead")
+
+    logging.info(f"Reconciliation of {args.source} started{' (dry run)' if args.dry_run else ''}")
+    # Created hosts get their keys from the PSK store, a dry run does not open it
+    if not args.dry_run:
+        zabbix_hosts.psk_store = PskStore()
+    if zabbix_authentication() != True:
+        sys.exit("Zabbix authentication failed, see the log for details")
+    get_templates_groups_proxies_id()
+    started = time.monotonic()
+    if not host_index.warm():
+        sys.exit("Reading hosts from Zabbix failed, see the log for details")
+    # Hosts missing from the index would be planned as new hosts and created twice
+    if not host_index.complete:
+        sys.exit("Not all Zabbix hosts fit in the host index, increase ZABBIX_SUITE_HOST_INDEX_SIZE")
+    loaded = time.monotonic()
+
+    plan_file = sys.stdout if args.plan == "-" else open(args.plan, "w")
+    totals = Counter()
+    reasons = Counter()
+    pending = {"create": [], "update": []}
+    appliers = {"create": apply_creates, "update": apply_updates}
+    pool = WorkerPool(args.workers, args.workers)
+    seen_ips = set()
+    for item in iter_netbox_vms(args.source):
+        entry = plan_vm(item, seen_ips)
+        with totals_lock:
+            totals["scanned"] += 1
+            totals[entry["action"]] += 1
+        if entry["action"] == "skip":
+            reasons[entry["reason"]] += 1
+        plan_file.write(json.dumps(entry) + "\n")
+        if args.dry_run or entry["action"] not in pending:
+            continue
+        pending[entry["action"]].append(entry)
+        if len(pending[entry["action"]]) >= args.batch_size:
+            # Blocks when all workers are busy, so memory stays bounded for any export size
+            pool.submit(appliers[entry["action"]], pending[entry["action"]], totals)
+            pending[entry["action"]] = []
+    for action, entries in pending.items():
+        if entries:
+            pool.submit(appliers[action], entries, totals)
+    pool.drain(None)
+    token_manager.logout()
+    if zabbix_hosts.psk_store is not None:
+        zabbix_hosts.psk_store.close()
+    if plan_file is not sys.stdout:
+        plan_file.close()
+
+    finished = time.monotonic()
+    report = {
+        "dry_run": args.dry_run,
+        "scanned": totals["scanned"],
+        "create": totals["create"],
+        "update": totals["update"],
+        "noop": totals["noop"],
+        "skip": totals["skip"],
+        "skip_reasons": dict(reasons),
+        "created": totals["created"],
+        "updated": totals["updated"],
+        "failed": totals["failed"],
+        # API calls sent for the updates, and the host.update calls one full update per host would have needed
+        # A single host with field, template and group changes needs more calls than it replaces, so they are not subtracted
+        "update_api_calls": update_calls.total(),
+        "update_api_calls_replaced": update_calls_replaced.total(),
+        "zabbix_load_seconds": round(loaded - started, 2),
+        "total_seconds": round(finished - started, 2),
+        "hosts_per_second": round(totals["scanned"] / max(finished - loaded, 1e-9), 1)
+    }
+    logging.info(f"Reconciliation finished: {report}")
+    print(json.dumps(report, indent=4), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()